@@ -0,0 +1,287 @@
+"""
+Benchmarks for reloadpyxel: how much it costs your game.
+
+This runs without a window: a stand-in for pyxel (see make_stub_pyxel) is used
+instead of the real one, so only reloadpyxel's own work is measured.
+
+Run it from the repository's folder with
+
+    python benchmarks/benchmark.py [--quick] [--output bench_output.txt]
+
+Each result is written as one line of JSON to the output file, for example
+{"benchmark": "scan", "params": {"files": 100}, "value": 41.2, "unit": "us"},
+so results from different versions can be compared.
+"""
+
+import argparse
+import ctypes
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+import zipfile
+
+
+class StubImage:
+    """Just enough of pyxel.Image for reloadpyxel. The stand-in image file
+    format is a "width height" line followed by one byte per pixel."""
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self._data = (ctypes.c_uint8 * (width * height))()
+        self._view = memoryview(self._data).cast('B')
+    def data_ptr(self):
+        return self._data
+    def pget(self, x, y):
+        return self._view[y * self.width + x]
+    def pset(self, x, y, color):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self._view[y * self.width + x] = color
+    def set(self, x, y, data):
+        for (j, row) in enumerate(data):
+            for (i, digit) in enumerate(row):
+                self.pset(x + i, y + j, int(digit, 16))
+    def blt(self, x, y, image, u, v, w, h, colkey=None, **kwargs):
+        w = min(w, self.width - x, image.width - u)
+        for j in range(max(0, min(h, self.height - y, image.height - v))):
+            start = (y + j) * self.width + x
+            source = (v + j) * image.width + u
+            self._view[start:start + w] = image._view[source:source + w]
+    def load(self, x, y, filename, incl_colors=None):
+        image = StubImage.from_image(filename)
+        self.blt(x, y, image, 0, 0, image.width, image.height)
+    @staticmethod
+    def from_image(filename, incl_colors=None):
+        with open(filename, 'rb') as f:
+            (header, pixels) = f.read().split(b'\n', 1)
+        (width, height) = map(int, header.split())
+        image = StubImage(width, height)
+        image._view[:] = pixels[:width * height]
+        return image
+
+
+def write_stub_image(filename, width, height, color):
+    with open(filename, 'wb') as f:
+        f.write(b'%d %d\n' % (width, height))
+        f.write(bytes([color]) * (width * height))
+
+
+def make_stub_pyxel():
+    """Return a module that stands in for pyxel."""
+    stub = types.ModuleType('pyxel')
+    stub.Image = StubImage
+    stub.images = [StubImage(256, 256) for _ in range(3)]
+    stub.tilemaps = []
+    stub.sounds = []
+    stub.musics = []
+    stub.colors = list(range(16))
+    stub.KEY_F1 = 1
+    stub.btnp = lambda key, hold=None, repeat=None: False
+    stub.rect = lambda *args: None
+    stub.text = lambda *args: None
+    return stub
+
+
+sys.modules['pyxel'] = make_stub_pyxel()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import reloadpyxel
+
+
+class EmptyApp:
+    def update(self):
+        pass
+    def draw(self):
+        pass
+    def reload(self, old_self):
+        reloadpyxel.copy_all_attributes(old_self, self)
+
+
+def median_time(function, repeat):
+    """Return the median time function() takes, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def result(name, params, seconds, unit='us'):
+    scale = {'us': 1e6, 'ms': 1e3}[unit]
+    return {'benchmark': name, 'params': params, 'value': round(seconds * scale, 3), 'unit': unit}
+
+
+def bench_frame_overhead(folder, sizes, frames):
+    """What _update and _draw add to each frame, with this many watched files.
+    The poll intervals are 0 so that every frame checks a batch of files
+    (at most scan_batch of them), which is the most polling can cost a frame."""
+    results = []
+    app = EmptyApp()
+    def bare():
+        for _ in range(frames):
+            app.update()
+            app.draw()
+    bare_time = median_time(bare, 5)
+    for count in sizes:
+        repyxel = reloadpyxel.ReloadPyxel(hotreload_code=False, watcher_backend='poll', project_root=folder,
+                                          poll_interval=0, code_poll_interval=0, max_poll_interval=0)
+        repyxel.app = app
+        for i in range(count):
+            filename = os.path.join(folder, f'frame_{i}.txt')
+            with open(filename, 'w') as f:
+                f.write('x')
+            repyxel.watch_resource(filename)
+        def frames_with_reloadpyxel():
+            for _ in range(frames):
+                repyxel._update()
+                repyxel._draw()
+        overhead = (median_time(frames_with_reloadpyxel, 5) - bare_time) / frames
+        results.append(result('frame_overhead', {'files': count, 'scan_batch': repyxel._scheduler.batch_size}, overhead))
+    return results
+
+
+def bench_scan(folder, file_sizes, module_sizes):
+    """How long one check for changes takes, against the number of watched
+    resource files and modules (when nothing changed)."""
+    results = []
+    for count in file_sizes:
+        repyxel = reloadpyxel.ReloadPyxel(hotreload_code=False, watcher_backend='poll', project_root=folder)
+        for i in range(count):
+            filename = os.path.join(folder, f'scan_{i}.txt')
+            with open(filename, 'w') as f:
+                f.write('x')
+            repyxel.watch_resource(filename)
+        results.append(result('scan', {'files': count}, median_time(repyxel._find_changes, 20)))
+    for count in module_sizes:
+        package = f'bench_modules_{count}'
+        os.makedirs(os.path.join(folder, package))
+        with open(os.path.join(folder, package, '__init__.py'), 'w') as f:
+            f.write('')
+        for i in range(count):
+            with open(os.path.join(folder, package, f'module_{i}.py'), 'w') as f:
+                f.write(f'from . import module_{i - 1}\n' if i else 'X = 1\n')
+            __import__(f'{package}.module_{i}')
+        repyxel = reloadpyxel.ReloadPyxel(hotreload_resources=False, watcher_backend='poll', project_root=folder,
+                                          watch_include=[f'{package}/*'])
+        repyxel._build_modules_list()
+        results.append(result('scan', {'modules': len(repyxel.mstats)}, median_time(repyxel._find_changes, 20)))
+    return results
+
+
+def bench_replay(folder, sizes):
+    """How long reloading one changed image takes, against the length of the
+    load list: with images side by side (only the changed one is reloaded),
+    and all in the same spot (every later one must be redone)."""
+    results = []
+    for layout in ('side_by_side', 'overlapping'):
+        for count in sizes:
+            repyxel = reloadpyxel.ReloadPyxel(hotreload_code=False, watcher_backend='poll', project_root=folder)
+            repyxel.app = EmptyApp()
+            filenames = []
+            for i in range(count):
+                filename = os.path.join(folder, f'replay_{layout}_{count}_{i}.img')
+                write_stub_image(filename, 16, 16, i % 16)
+                filenames.append(filename)
+                (x, y) = ((i % 16) * 16, (i // 16) * 16) if layout == 'side_by_side' else (0, 0)
+                repyxel.image_load(0, x, y, filename)
+            times = []
+            for color in range(10):
+                write_stub_image(filenames[0], 16, 16, color)
+                times.append(median_time(lambda: repyxel._reload_resources({filenames[0]}), 1))
+            results.append(result('replay', {'load_list': count, 'layout': layout}, statistics.median(times)))
+    return results
+
+
+def bench_renew_app(folder, sizes):
+    """How long giving the app new code takes, against the number of objects
+    it holds: _renew_app (a new App, whose reload copies the attributes),
+    and moving the objects to their reloaded class (_migrate_instances)."""
+    results = []
+    source = ('import reloadpyxel\n'
+              'class Entity:\n'
+              '    def __init__(self, i): self.x = i; self.y = i; self.children = []\n'
+              'class App:\n'
+              '    def __init__(self, repyxel): self.entities = []\n'
+              '    def update(self): pass\n'
+              '    def draw(self): pass\n'
+              '    def reload(self, old_self): reloadpyxel.copy_all_attributes(old_self, self)\n')
+    for count in sizes:
+        mname = f'bench_game_{count}'
+        with open(os.path.join(folder, mname + '.py'), 'w') as f:
+            f.write(source)
+        module = __import__(mname)
+        repyxel = reloadpyxel.ReloadPyxel(hotreload_resources=False, watcher_backend='poll', project_root=folder)
+        repyxel.app = module.App(repyxel)
+        repyxel.app.entities = [module.Entity(i) for i in range(count)]
+        results.append(result('renew_app', {'objects': count}, median_time(repyxel._renew_app, 10)))
+        code = compile(source, module.__file__, 'exec')
+        times = []
+        for _ in range(5):
+            old_classes = {mname: reloadpyxel._module_classes(module)}
+            exec(code, module.__dict__)
+            times.append(median_time(lambda: reloadpyxel._migrate_instances(repyxel.app, old_classes, {mname}), 1))
+        results.append(result('migrate_instances', {'objects': count}, statistics.median(times)))
+    return results
+
+
+def bench_pyxres_reload(folder):
+    """How long reloading a .pyxres file takes when one pixel of its first
+    image changed: reading the file and parsing what changed (prepare),
+    and all of it (prepare and writing the changed row)."""
+    results = []
+    assets = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                          'examples', 'resources_only', 'pyxel_originals', 'assets')
+    for name in ('platformer', 'sample'):
+        with zipfile.ZipFile(os.path.join(assets, name + '.pyxres')) as archive:
+            text = archive.read('pyxel_resource.toml').decode('utf-8')
+        filename = os.path.join(folder, name + '.pyxres')
+        versions = []
+        for first_pixel in ('1', '2'):
+            with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('pyxel_resource.toml', text.replace('data = [[', 'data = [[' + first_pixel, 1))
+            with open(filename, 'rb') as f:
+                versions.append(f.read())
+        command = reloadpyxel._PyxelLoad_Command(filename, {'filename': filename})
+        command._data = versions[0]
+        old_parts = reloadpyxel._split_pyxres(versions[0])
+        def prepare():
+            command._parts = old_parts
+            command.prepare()
+        def reload():
+            command._parts = old_parts
+            command.reload()
+        results.append(result('pyxres_reload', {'file': name, 'step': 'prepare'}, median_time(prepare, 20), 'ms'))
+        results.append(result('pyxres_reload', {'file': name, 'step': 'all'}, median_time(reload, 20), 'ms'))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, for a quick check')
+    parser.add_argument('--output', default='bench_output.txt', help='where to write the results (JSON lines)')
+    args = parser.parse_args()
+    if args.quick:
+        (files, modules, load_lists, objects, frames) = ([10, 100], [10], [1, 10], [100, 1000], 100)
+    else:
+        (files, modules, load_lists, objects, frames) = ([10, 100, 1000], [10, 100], [1, 10, 100], [100, 1000, 10000], 1000)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        sys.path.insert(0, folder)
+        results += bench_frame_overhead(folder, [0] + files, frames)
+        results += bench_scan(folder, files, modules)
+        results += bench_replay(folder, load_lists)
+        results += bench_renew_app(folder, objects)
+        results += bench_pyxres_reload(folder)
+    with open(args.output, 'w') as f:
+        for line in results:
+            f.write(json.dumps(line) + '\n')
+    for line in results:
+        params = ', '.join(f'{key}={value}' for (key, value) in line['params'].items())
+        print(f"{line['benchmark']:<18} {params:<40} {line['value']:>12.3f} {line['unit']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import pyxel
 import reloadpyxel
+import os
 import shutil
 
 # A little self-test:
@@ -8,9 +9,14 @@ import shutil
 STATES = [
     "TEST_LOAD", "TEST_EXCL_IMAGES", "TEST_EXCL_TILEMAPS",
     "TEST_IMG_LOAD",
-    "TEST_RELOAD", "TEST_RELOAD_EXCL_IMG"
+    "TEST_RELOAD", "TEST_RELOAD_EXCL_IMG", "TEST_PARTIAL_RELOAD",
+    "TEST_RELOAD_RECREATED_DIR", "TEST_SNAPSHOT"
 ]
 STATE_DURATION = 30
+# A reload lands once the change has been seen (within max_poll_interval,
+# 0.15s) and the file has stayed the same for settle_time (0.1s), so give
+# it half a second (at 30 fps) before calling it a failure.
+RELOAD_GRACE = 15
 
 class App:
     @staticmethod
@@ -27,12 +33,24 @@ class App:
         ryxel.load("cold_vert.pyxres")
         shutil.copyfile("hot_horiz.pyxres", "test_resource_1.pyxres")
         shutil.copyfile("hot_horiz.pyxres", "test_resource_2.pyxres")
+        # The files in test_tree that were loaded (see TEST_RELOAD_RECREATED_DIR)
+        shutil.rmtree("test_tree", ignore_errors=True)
+        os.makedirs("test_tree/sub")
+        self.tree_loaded = []
+        ryxel.watch_directory("test_tree", "*.txt", self.tree_loaded.append)
         self.set_state(0)
         self.state_countdown = STATE_DURATION
         self.running = True
         # Do not call ryxel.run (main does it for you)
 
     def set_state(self, state_index):
+        # None until the partial reload was compared with pyxel.load
+        self.partial_ok = None
+        self.changed_recreated = False
+        # The file we expect to be loaded from test_tree, if any
+        self.tree_expected = None
+        # None until a snapshot of pyxel's banks was restored
+        self.snapshot_ok = None
         self.state_index = state_index
         self.state_name = STATES[state_index]
         (self.temp, self.orient) = self._load_state(self.state_name)
@@ -75,6 +93,45 @@ class App:
                 # Trigger reload of the first file. Does the tilemap override stay?
                 shutil.copyfile("hot_horiz.pyxres", "test_resource_1.pyxres")
                 return ("hot", "vert")
+            case "TEST_PARTIAL_RELOAD":
+                # Only the rows that changed are reloaded. Once that's done
+                # (see update), the result must match a full pyxel.load.
+                # cold_vert_tail only changes the last row stored in the file,
+                # which pyxel repeats for all the rows after it.
+                shutil.copyfile("cold_vert.pyxres", "test_resource_3.pyxres")
+                self.ryxel.load("test_resource_3.pyxres")
+                shutil.copyfile("cold_vert_tail.pyxres", "test_resource_3.pyxres")
+                return ("cold", "vert")
+            case "TEST_RELOAD_RECREATED_DIR":
+                # The folder of a loaded file is deleted and created again,
+                # like a git checkout does. Later changes to the file (see
+                # update, once we looked at the folder again) must still be seen.
+                shutil.rmtree("test_dir", ignore_errors=True)
+                os.mkdir("test_dir")
+                shutil.copyfile("hot_horiz.pyxres", "test_dir/test_resource.pyxres")
+                self.ryxel.load("test_dir/test_resource.pyxres")
+                shutil.rmtree("test_dir")
+                os.mkdir("test_dir")
+                shutil.copyfile("hot_horiz.pyxres", "test_dir/test_resource.pyxres")
+                # The same with a subfolder of a watched directory.
+                shutil.rmtree("test_tree/sub")
+                os.mkdir("test_tree/sub")
+                return ("hot", "horiz")
+            case "TEST_SNAPSHOT":
+                # Pyxel gives a new object each time its banks are indexed.
+                # A snapshot must still restore them as pyxel's own banks:
+                # drawing on the restored image must change pyxel.images[0].
+                self.ryxel.load("hot_horiz.pyxres")
+                reloadpyxel._write_snapshot("test_snapshot", (pyxel.images[0], pyxel.tilemaps[0]), self.ryxel)
+                (image, tilemap) = reloadpyxel._read_snapshot("test_snapshot", self.ryxel)
+                (color, tile) = (pyxel.images[0].pget(0,0), pyxel.tilemaps[0].pget(0,0))
+                image.pset(0,0, (color+1) % 16)
+                tilemap.pset(0,0, (tile[0]+1, tile[1]))
+                self.snapshot_ok = (pyxel.images[0].pget(0,0) == (color+1) % 16
+                                    and pyxel.tilemaps[0].pget(0,0) == (tile[0]+1, tile[1]))
+                image.pset(0,0, color)
+                tilemap.pset(0,0, tile)
+                return ("hot", "horiz")
             case _:
                 return ("?", "?")
 
@@ -97,6 +154,20 @@ class App:
             self.state_countdown = STATE_DURATION
         else:
             self.state_countdown -= 1
+        if self.state_name == "TEST_RELOAD_RECREATED_DIR" and not self.changed_recreated \
+                and self.state_countdown == STATE_DURATION - 15:
+            shutil.copyfile("cold_vert.pyxres", "test_dir/test_resource.pyxres")
+            (self.temp, self.orient) = ("cold", "vert")
+            self.tree_expected = os.path.abspath("test_tree/sub/new.txt")
+            with open(self.tree_expected, "w") as f:
+                f.write(str(pyxel.frame_count))
+            # The reload gets as long as in the other tests.
+            self.state_countdown = STATE_DURATION
+            self.changed_recreated = True
+        if self.state_name == "TEST_PARTIAL_RELOAD" and self.state_countdown == 5:
+            before = self.banks_contents()
+            pyxel.load("test_resource_3.pyxres")
+            self.partial_ok = (before == self.banks_contents())
 
     def draw(self):
         """Called every frame, here draw the world."""
@@ -112,7 +183,7 @@ class App:
         if ok:
             color = 11
             text = "OK"
-        elif self.state_countdown > STATE_DURATION-11:
+        elif self.state_countdown > STATE_DURATION-RELOAD_GRACE:
             # Failed, but we're giving it more time
             color = 13
             text = "HMM"
@@ -126,7 +197,7 @@ class App:
         if ok:
             color = 11
             text = "OK"
-        elif self.state_countdown > STATE_DURATION-11:
+        elif self.state_countdown > STATE_DURATION-RELOAD_GRACE:
             # Failed, but we're giving it more time
             color = 13
             text = "HMM"
@@ -135,6 +206,28 @@ class App:
             color = 9
             text = "FAIL"
         pyxel.text(4,108, "Tilemap pattern: " + tilemap_pattern + " " + text, color)
+        if self.partial_ok is not None:
+            (color, text) = (11, "OK") if self.partial_ok else (9, "FAIL")
+            pyxel.rect(0,82, 120,8, 0)
+            pyxel.text(4,83, "Same as pyxel.load: " + text, color)
+        if self.snapshot_ok is not None:
+            (color, text) = (11, "OK") if self.snapshot_ok else (9, "FAIL")
+            pyxel.rect(0,82, 120,8, 0)
+            pyxel.text(4,83, "Snapshot banks: " + text, color)
+        if self.tree_expected is not None:
+            if self.tree_expected in self.tree_loaded:
+                (color, text) = (11, "OK")
+            elif self.state_countdown > STATE_DURATION-RELOAD_GRACE:
+                (color, text) = (13, "HMM")
+            else:
+                (color, text) = (9, "FAIL")
+            pyxel.rect(0,82, 120,8, 0)
+            pyxel.text(4,83, "Folder watch: " + text, color)
+
+    def banks_contents(self):
+        pixels = [pyxel.images[0].pget(x,y) for y in range(256) for x in range(256)]
+        tiles = [pyxel.tilemaps[0].pget(x,y) for y in range(256) for x in range(256)]
+        return (pixels, tiles)
 
     def identify_tilemap(self):
         is_horizontal = True
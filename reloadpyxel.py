@@ -19,37 +19,215 @@ For it to autoreload your code, you must
    It will be called every time we have reloaded the resources.
 """
 
-import importlib
+import array
+import ast
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import enum
+import errno
+import fnmatch
+import functools
+import hashlib
+import io
+import json
+import mmap
 import pyxel
 import os
+import pickle
+import queue
+import re
+import site
+import struct
 import sys
+import sysconfig
+import tempfile
+import threading
+import time
+import traceback
+import types
+import xml.etree.ElementTree as ElementTree
+import zipfile
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11: .pyxres files are always reloaded whole.
+    tomllib = None
 
 
 def copy_all_attributes(source_object, dest_object):
     """Shallow copy all the attributes from the source to the destination.
-    Returns the destination object."""
-    dest_object.__dict__.update(source_object.__dict__)
+    Returns the destination object.
+
+    This works with __slots__, and with frozen dataclasses. Attributes the
+    destination has no room for (a slot that was removed) are skipped."""
+    (copy_dict, dict_to_slots, slots) = _transfer_plan(type(source_object), type(dest_object))
+    if copy_dict:
+        dest_object.__dict__.update(source_object.__dict__)
+    elif dict_to_slots:
+        for (name, value) in source_object.__dict__.items():
+            if name in dict_to_slots: object.__setattr__(dest_object, name, value)
+    for name in slots:
+        try:
+            value = getattr(source_object, name)
+        except AttributeError:
+            # A slot that was never set.
+            continue
+        object.__setattr__(dest_object, name, value)
     return dest_object
 
 
 class ReloadPyxel:
     """ReloadPyxel helps add hot reload for code and resources for your Pyxel game."""
-    def __init__(self, hotreload_resources=True, hotreload_code=True):
+    def __init__(self, hotreload_resources=True, hotreload_code=True, watch_in_background=False,
+                 watcher_backend='auto', project_root=None, watch_include=None, watch_exclude=None,
+                 settle_time=0.1, cache_dir=None, cache_size=64 << 20, decode_in_background=False,
+                 reload_budget_ms=None, migrate_instances=True, patch_functions=False,
+                 snapshot_file='.reloadpyxel_snapshot', restore_snapshot=False,
+                 show_hud=False, hud_key=None, trace_file=None,
+                 poll_interval=0.05, code_poll_interval=0.1, max_poll_interval=0.15, scan_batch=64):
         """ReloadPyxel remembers the resource files you're loading so it can reload them.
 
         Set hotreload_resources or hotreload_code to False to disable resource
-        or code hot reload, respectively."""
+        or code hot reload, respectively.
+        Set watch_in_background to True to look for file changes on a separate
+        thread, so the game never waits on the disk.
+        watcher_backend picks how we find out about changes: 'poll' checks
+        the modification time of every file, 'inotify' asks Linux to tell us
+        (so nothing is checked while nothing changes), and 'auto' uses
+        inotify when available and polling otherwise.
+
+        Resource files are checked every poll_interval seconds, and code
+        every code_poll_interval seconds, right after a change. While
+        nothing changes, we check less and less often, down to once every
+        max_poll_interval seconds. When polling on the game thread, each
+        frame checks at most scan_batch files, so a check of many files is
+        spread over several frames.
+
+        Only the modules under project_root (by default, the current
+        directory) are watched for code changes, never the standard library
+        or installed packages. watch_include and watch_exclude are lists of
+        glob patterns, relative to project_root (like 'game.py' or 'levels/*'),
+        to narrow that down further.
+
+        Changes are reloaded together, once none of the changed files has
+        changed again for settle_time seconds. This way a save that takes a
+        while, or a 'git checkout' that touches many files, causes a single
+        reload.
+
+        If cache_dir is set, decoded images are kept in that directory so
+        the next launch doesn't have to decode them again. The least
+        recently used ones are removed once it holds more than cache_size
+        bytes.
+
+        Set decode_in_background to True to read and decode changed resource
+        files on a separate thread. The results are then written into pyxel's
+        banks all at once, between two frames.
+
+        Set reload_budget_ms to spread reloading resources over several
+        frames, spending at most about that many milliseconds per frame.
+        The reloaded images, tilemaps, sounds and musics only show up in
+        pyxel's banks once they are all done.
+
+        With migrate_instances, after code is reloaded the objects your app
+        holds on to are switched to the new version of their class (see
+        _migrate_instances), so you don't have to re-create them yourself.
+
+        With patch_functions, when only the bodies of functions or methods
+        changed, the new code is put into the existing functions instead
+        (see _function_patches): the module isn't run again, and the app
+        is kept as is. Other changes reload the module as usual.
+
+        snapshot() saves your app to snapshot_file. With restore_snapshot,
+        run() starts from the app saved there (if there is one) instead of
+        the one it's given, so a restart takes you back where you were.
+
+        show_hud draws timings over your game (see hud_lines): how long
+        frames take, and what checking for changes and reloading cost.
+        Pressing hud_key (a pyxel key, like pyxel.KEY_F1) shows or hides it.
+
+        Set trace_file to record when each frame, check for changes and
+        reload starts and ends. A file name ending in .jsonl gets one event
+        per line, anything else is a Chrome trace (open it in Perfetto or
+        chrome://tracing). The events are written by a separate thread."""
         # list of commands to "load"
         self.load_list = []
-        # fname -> last known update time for resources
+        # fname -> last known _FileStamp for resources
         self.fstats = {}
-        self.ticks = 0
-        # We check for updates every check_period ticks
-        # An advantage of not doing it immediately is we reduce
-        # the likelihood of reading a file mid-save.
-        self.check_period = 10
+        # When to look for changes (see _PollScheduler).
+        self._scheduler = _PollScheduler(poll_interval, code_poll_interval, max_poll_interval, scan_batch)
         self.hotreload_resources = hotreload_resources
         self.hotreload_code = hotreload_code
+        # When watching in the background, the watcher thread looks for
+        # changes and sends them to the game thread via this queue.
+        # The reloads themselves still happen on the game thread,
+        # between two frames.
+        self.watch_in_background = watch_in_background
+        self.changes = queue.Queue()
+        self._watcher = None
+        self._backend = _make_watcher_backend(watcher_backend)
+        atexit.register(self._close)
+        # Which modules we watch for code changes.
+        self.project_root = os.path.abspath(project_root or os.getcwd())
+        self.watch_include = watch_include or ['*']
+        self.watch_exclude = watch_exclude or []
+        # module name -> last known _FileStamp of its source
+        self.mstats = {}
+        # module name -> names of the modules its source imports
+        self.imports = {}
+        # How long the checks for changes take.
+        self.scan_count = 0
+        self.scan_time_total = 0.0
+        self.last_scan_time = 0.0
+        # Files that were touched but whose contents didn't change.
+        self.skipped_reloads = 0
+        # What the last resource reload changed, as a list of
+        # (kind, index, (x, y, w, h)). The rectangle is None if the
+        # whole image, tilemap, sound or music may have changed.
+        self.dirty_regions = []
+        # Changes we found, waiting to settle before we reload them.
+        self.settle_time = settle_time
+        self._pending = _ReloadTransaction()
+        self._cache = _AssetCache(cache_dir, cache_size) if cache_dir else None
+        # When decoding in the background, the changed resources being
+        # decoded as (future, changed), and the ones waiting for their turn.
+        self.decode_in_background = decode_in_background
+        self._decoder = None
+        self._decoding = None
+        self._to_decode = {}
+        # Changed modules are compiled on the compiler thread: the job being
+        # compiled as (future, changed), and the modules waiting for their turn.
+        self._compiler = None
+        self._compiling = None
+        self._to_compile = []
+        # The last syntax error in a changed module, as text, or None.
+        self.code_error = None
+        self.migrate_instances = migrate_instances
+        # module name -> the code the module's current functions come from,
+        # to compare changes against. The first versions are compiled on the
+        # compiler thread when we start: (future, {module name: digest}).
+        self.patch_functions = patch_functions
+        self._module_code = {}
+        self._baseline = None
+        self.snapshot_file = snapshot_file
+        self.restore_snapshot = restore_snapshot
+        # Timings for the HUD.
+        self.perf = _PerfStats()
+        self.show_hud = show_hud
+        self.hud_key = hud_key
+        self.trace = _TraceRecorder(trace_file) if trace_file else _NO_TRACE
+        # From saving a file to seeing the change, see latency_histograms.
+        self._latency = _LatencyTracker()
+        # Resource reloads that are spread over several frames, oldest first.
+        self.reload_budget_ms = reload_budget_ms
+        self._reload_jobs = []
+        # Directories watched with watch_directory (see _DirectoryWatch).
+        self.directories = []
+        # Protects fstats and mstats, which the watcher thread also updates.
+        self._lock = threading.Lock()
         self.images = []
         self.tilemaps = []
         for i in range(3):
@@ -59,40 +237,130 @@ class ReloadPyxel:
     def load(self, name_of_resource_file, **kwargs):
         """Load the resource file, then reload it if it changes."""
         kwargs['filename'] = name_of_resource_file
+        # A reload in progress would write over what we load now.
+        self._finish_reload_jobs()
         command = _PyxelLoad_Command(name_of_resource_file, kwargs)
         if self.hotreload_resources:
             self.load_list += [command]
-            self._update_file_time(name_of_resource_file)
+            self._watch_file(name_of_resource_file)
+        self.trace.begin('command.exec', command.filename())
         command.exec()
+        self.trace.end('command.exec')
 
     def image_load(self, image_index, x, y, filename, incl_colors=None):
         """Load this image file into the specified image bank at the specified offset
         (and reload it if it changes)."""
-        command = _ImageLoad_Command(image_index, x, y, filename, incl_colors)
+        # A reload in progress would write over what we load now.
+        self._finish_reload_jobs()
+        command = _ImageLoad_Command(image_index, x, y, filename, incl_colors, self._cache)
         if self.hotreload_resources:
             self.load_list += [command]
-            self._update_file_time(filename)
+            self._watch_file(filename)
+        self.trace.begin('command.exec', command.filename())
         command.exec()
+        self.trace.end('command.exec')
 
     def tilemap_load(self, tilemap_index, x, y, filename, layer):
         """Load this TMX tilemap file to the specified tilemap bank at the
         specified offset (and reload it if it changes)."""
+        # A reload in progress would write over what we load now.
+        self._finish_reload_jobs()
         command = _TilemapLoad_Command(tilemap_index, x, y, filename, layer)
         if self.hotreload_resources:
             self.load_list += [command]
-            self._update_file_time(filename)
+            self._watch_file(filename)
+        self.trace.begin('command.exec', command.filename())
         command.exec()
+        self.trace.end('command.exec')
 
     def watch_resource(self, filename):
         """Call App.reload_resource if this file is modified."""
         command = _Watch_Command(filename)
         if self.hotreload_resources:
             self.load_list += [command]
-            self._update_file_time(filename)        
+            self._watch_file(filename)
+
+    def watch_directory(self, path, pattern='*', loader=None):
+        """Call loader(filename) for each file in the directory (and its
+        subdirectories) whose name matches the pattern, like '*.png'.
+        Afterwards, call it again for each of those files that is created,
+        changed or deleted (then the file doesn't exist anymore), and call
+        App.reload_resource.
+
+        This is cheaper than watching each file: a directory is only listed
+        again when files were added to it or removed from it."""
+        watch = _DirectoryWatch(path, pattern, loader, self._backend)
+        if self.hotreload_resources:
+            with self._lock:
+                self.directories.append(watch)
+        if loader:
+            for filename in watch.files():
+                loader(filename)
+
+    def reload_progress(self):
+        """Return (steps done, steps in total) for the resource reload in
+        progress, or None if there isn't one."""
+        if not self._reload_jobs: return None
+        job = self._reload_jobs[0]
+        return (job.done, job.total)
+
+    def snapshot(self, filename=None):
+        """Save the app, and everything it holds on to, to the snapshot file."""
+        _write_snapshot(filename or self.snapshot_file, self.app, self)
+
+    def restore(self, filename=None):
+        """Replace the app with the one saved in the snapshot file, and return it."""
+        self.app = _read_snapshot(filename or self.snapshot_file, self)
+        return self.app
+
+    def hud_lines(self):
+        """Return the lines of text the HUD shows."""
+        perf = self.perf
+        lines = []
+        if perf.frame_times:
+            times = sorted(perf.frame_times)
+            lines.append('frame p50 %.1f p95 %.1f p99 %.1f ms' % tuple(
+                _percentile(times, fraction) * 1000 for fraction in (0.5, 0.95, 0.99)))
+        if perf.update_times:
+            lines.append('update %.2f draw %.2f ms' % (_average(perf.update_times) * 1000,
+                                                       _average(perf.draw_times) * 1000))
+        lines.append('scan %.2f ms, %d files' % (self.last_scan_time * 1000, len(self.mstats) + len(self.fstats)))
+        (total, parts) = perf.last_reload
+        if parts:
+            lines.append('reload %.1f ms' % (total * 1000))
+            for (name, seconds) in parts[:3]:
+                lines.append(' %s %.1f' % (name[-20:], seconds * 1000))
+        return lines
+
+    def latency_histograms(self):
+        """Return how long changes took to show up, from the moment the file
+        was saved (its modification time), as {stage: histogram}:
+          'detect': until we noticed the change,
+          'apply': from then until the change was reloaded (this includes
+                   waiting for the files to settle, and decoding or compiling),
+          'draw': from then until the next frame was drawn,
+          'total': from saving the file to that frame.
+        Each histogram is a dict with 'count', 'mean_ms', 'max_ms' and
+        'buckets', a list of (upper bound in ms, count)."""
+        return self._latency.histograms()
+
+    def watch_report(self):
+        """Return a short description of what we watch and what checking it costs."""
+        report = (f'Watching {len(self.mstats)} modules and {len(self.fstats)} resource files '
+                  f'under {self.project_root}.')
+        if self.scan_count:
+            average = self.scan_time_total / self.scan_count
+            report += (f' Last check took {self.last_scan_time*1000:.3f} ms,'
+                       f' {average*1000:.3f} ms on average over {self.scan_count} checks.')
+        if self.skipped_reloads:
+            report += f' Skipped {self.skipped_reloads} reloads of files whose contents did not change.'
+        return report
 
     def run(self, the_app):
         """Run your game, also periodically check for file changes."""
         self.app = the_app
+        if self.restore_snapshot and os.path.exists(self.snapshot_file):
+            the_app = self.restore()
         if (not hasattr(the_app, 'update')):
             raise 'App needs to have an "update" method'
         if (not hasattr(the_app, 'draw')):
@@ -104,68 +372,438 @@ class ReloadPyxel:
             self._build_modules_list()
             # Double-check that the reload method does not crash.
             self.app.reload(self.app)
+        if self.watch_in_background:
+            self._watcher = _WatcherThread(self)
+            self._watcher.start()
         pyxel.run(self._update, self._draw)
 
 
     # You don't need to call any of the below methods yourself.
 
-    def _update_file_time(self, filename, mtime=None):
-        if mtime is None: mtime = os.stat(filename).st_mtime
-        self.fstats[filename] = mtime
+    def _close(self):
+        """Stop the watcher thread and close the watcher backend (at exit)."""
+        if self._watcher:
+            self._watcher.stop()
+            self._watcher.join()
+            self._watcher = None
+        self._backend.close()
+
+    def _watch_file(self, filename):
+        self._backend.watch(filename)
+        self._update_file_stamp(filename)
+
+    def _update_file_stamp(self, filename, stamp=None):
+        if stamp is None: stamp = _restamp(filename)
+        with self._lock:
+            self.fstats[filename] = stamp
 
-    def _get_module_mtime(self, m):
+    def _get_module_source(self, m):
+        """Return the path of the module's .py file, or None."""
         if (not hasattr(m, '__file__')) or (not m.__file__): return None
-        try:
-            _path, ext = os.path.splitext(m.__file__)
-            if ext.lower() != '.py': return None
-            return os.stat(m.__file__).st_mtime
-        except OSError:
-            return None
+        _path, ext = os.path.splitext(m.__file__)
+        if ext.lower() != '.py': return None
+        return m.__file__
+
+    def _library_dirs(self):
+        """The directories of the standard library and of installed packages."""
+        dirs = set()
+        paths = sysconfig.get_paths()
+        for key in ('stdlib', 'platstdlib', 'purelib', 'platlib'):
+            if key in paths: dirs.add(paths[key])
+        if hasattr(site, 'getsitepackages'):
+            dirs.update(site.getsitepackages())
+        if site.ENABLE_USER_SITE:
+            dirs.add(site.getusersitepackages())
+        return [os.path.join(os.path.abspath(d), '') for d in dirs]
+
+    def _is_project_module(self, path, library_dirs):
+        """Whether the module in that file is one of ours to watch."""
+        path = os.path.abspath(path)
+        if any(path.startswith(d) for d in library_dirs): return False
+        if not path.startswith(os.path.join(self.project_root, '')): return False
+        relpath = os.path.relpath(path, self.project_root).replace(os.sep, '/')
+        if not any(fnmatch.fnmatch(relpath, pattern) for pattern in self.watch_include): return False
+        return not any(fnmatch.fnmatch(relpath, pattern) for pattern in self.watch_exclude)
 
     def _build_modules_list(self):
         """populate state.mstats"""
         self.mstats = {}
-        for (mname,m) in sys.modules.items():
-            # We can't reload ourselves
-            if mname == 'reloadpyxel': continue
-            mtime = self._get_module_mtime(m)
-            if not mtime: continue
-            self.mstats[mname] = mtime
-
-    def _check_for_resource_updates(self):
-        """Call pyxel.load on all modified resource files."""
-        # Update mtime and list files that changed
+        library_dirs = self._library_dirs()
+        for (mname,m) in list(sys.modules.items()):
+            # We can't reload ourselves, and main is not a module we can reload.
+            if mname in ('reloadpyxel', '__main__'): continue
+            if not getattr(m, '__file__', None): continue
+            if not self._is_project_module(m.__file__, library_dirs): continue
+            path = self._get_module_source(m)
+            if not path: continue
+            try:
+                stamp = _restamp(path)
+            except OSError:
+                continue
+            self._backend.watch(path)
+            self.mstats[mname] = stamp
+            self.imports[mname] = _module_imports(mname, path)
+        if self.patch_functions:
+            paths = {mname: self._get_module_source(sys.modules[mname]) for mname in self.mstats}
+            digests = {mname: stamp.digest for (mname, stamp) in self.mstats.items()}
+            self._baseline = (self._compiler_pool().submit(_compile_sources, paths), digests)
+
+    def _find_resource_changes(self, candidates=None, only=None):
+        """Return {filename: _FileStamp} for the resource files whose contents
+        changed since we last looked, and remember their new stamp.
+
+        If the backend told us which files may have changed (candidates),
+        only those are checked. 'only' limits the check to those files."""
+        with self._lock:
+            if only is None:
+                files = list(self.fstats.items())
+            else:
+                files = [(fname, self.fstats[fname]) for fname in only if fname in self.fstats]
         changed = {}
-        for (fname,last_loaded) in self.fstats.items():
-            mtime = os.stat(fname).st_mtime
-            if mtime != last_loaded:
-                # measure only once, to avoid a race condition
-                self._update_file_time(fname, mtime=mtime)
-                changed[fname]=True
-        # reload all changed files (in the correct order, with the correct arguments)
-        must_reload = False
-        for command in self.load_list:
-            must_reload = must_reload or command.filename() in changed
-            if must_reload:
-                command.exec()
+        for (fname, stamp) in files:
+            if candidates is not None and fname not in candidates: continue
+            new_stamp = self._new_stamp(fname, stamp)
+            if new_stamp is None: continue
+            self._update_file_stamp(fname, new_stamp)
+            if self._same_contents(stamp, new_stamp): continue
+            changed[fname] = new_stamp
+            self._latency.detected(('resource', fname), new_stamp.mtime_ns)
+        return changed
+
+    def _find_module_changes(self, candidates=None, only=None):
+        """Return the names of the modules whose source file contents changed
+        since we last looked, and remember their new stamp.
+
+        If the backend told us which files may have changed (candidates),
+        only those are checked. 'only' limits the check to those modules."""
+        if candidates is not None and not candidates: return []
+        with self._lock:
+            if only is None:
+                modules = list(self.mstats.items())
+            else:
+                modules = [(mname, self.mstats[mname]) for mname in only if mname in self.mstats]
+        changed = []
+        for (mname, stamp) in modules:
+            path = self._get_module_source(sys.modules.get(mname))
+            if not path: continue
+            if candidates is not None and path not in candidates: continue
+            new_stamp = self._new_stamp(path, stamp)
+            if new_stamp is None: continue
+            with self._lock:
+                self.mstats[mname] = new_stamp
+            if self._same_contents(stamp, new_stamp): continue
+            changed.append(mname)
+            self._latency.detected(('code', mname), new_stamp.mtime_ns)
+        return changed
+
+    def _find_directory_changes(self, candidates=None, only=None):
+        """Return {filename: _FileStamp, or None if it was deleted} for the
+        files created, changed or deleted in the watched directories
+        (or in those of 'only')."""
+        with self._lock:
+            directories = list(self.directories) if only is None else only
+        changed = {}
+        for watch in directories:
+            for (fname, stamp) in watch.scan(candidates).items():
+                changed[fname] = stamp
+                if stamp: self._latency.detected(('resource', fname), stamp.mtime_ns)
+        return changed
+
+    def _directory_loads(self, changed):
+        """Return [(loader, filename)] for the changed files in watched directories."""
+        return [(watch.loader, fname) for watch in self.directories if watch.loader
+                for fname in sorted(changed) if watch.owns(fname)]
+
+    def _new_stamp(self, filename, stamp):
+        """Return the file's new stamp if its size or mtime changed, else None."""
+        try:
+            return _restamp(filename, stamp)
+        except OSError:
+            # Probably mid-save, we'll see it next time.
+            return None
+
+    def _same_contents(self, stamp, new_stamp):
+        """True if the file was touched, or rewritten with the same bytes:
+        then there is nothing to reload."""
+        if new_stamp.digest != stamp.digest: return False
+        self.skipped_reloads += 1
+        return True
+
+    def _reload_resources(self, changed, prepared=None):
+        """Re-run the load commands for the files in 'changed'.
+
+        'prepared' has the already decoded files for some of the commands
+        (see _prepare_all). With a reload budget, this only starts the
+        reload: _run_reload_jobs does the work over the next frames."""
+        job = _ReloadJob(self, changed, prepared or {}, staged=self.reload_budget_ms is not None)
+        self._reload_jobs.append(job)
+        if self.reload_budget_ms is None:
+            self._finish_reload_jobs()
+
+    def _reload_steps(self, job):
+        """The steps of a resource reload, one per load command (see _ReloadJob).
+        Returns where we wrote."""
+        # reload all changed files (in the correct order, with the correct arguments).
+        # We also re-run the later commands that write to the same place as
+        # something we reloaded, so that what they override stays overridden.
+        # The other commands are left alone.
+        dirty = []
+        for command in list(self.load_list):
+            start = time.perf_counter()
+            try:
+                writes = self._replay(command, job, dirty)
+            except _NeedsLiveBanks:
+                # This one can only write to pyxel's banks directly. Finish
+                # the whole reload now, so nobody sees it half done.
+                job.go_live()
+                writes = self._replay(command, job, dirty)
+            if writes:
+                self.perf.add_reload_part(os.path.basename(command.filename()), time.perf_counter() - start)
+                dirty += writes
+            yield
+        for (loader, fname) in self._directory_loads(job.changed):
+            # The loader writes to pyxel's banks itself.
+            job.go_live()
+            start = time.perf_counter()
+            loader(fname)
+            self.perf.add_reload_part(os.path.basename(fname), time.perf_counter() - start)
+            yield
+        return dirty
+
+    def _replay(self, command, job, dirty):
+        """Reload or re-run the command if needed, and return where it wrote."""
+        writes = command.writes()
+        if _overlaps(writes, dirty):
+            # Something we just reloaded wrote over part of what
+            # this command loaded, so it must be redone entirely.
+            self.trace.begin('command.exec', command.filename())
+            command.exec(job.banks)
+            self.trace.end('command.exec')
+            return writes
+        if command.filename() in job.changed:
+            # It only needs to apply what changed in its file.
+            # reload() tells us where it wrote, or None if it doesn't know.
+            self.trace.begin('command.reload', command.filename())
+            written = command.reload(job.prepared.get(command), job.banks)
+            self.trace.end('command.reload')
+            return writes if written is None else written
+        return None
+
+    def _run_reload_jobs(self):
+        """Spend up to reload_budget_ms on the resource reloads in progress."""
+        budget = self.reload_budget_ms / 1000 if self.reload_budget_ms is not None else None
+        while self._reload_jobs:
+            job = self._reload_jobs[0]
+            if not job.run(budget):
+                return
+            self._reload_jobs.pop(0)
+            self._resources_reloaded(job)
+            # Later jobs wait for the next frame.
+            if budget is not None: return
+
+    def _finish_reload_jobs(self):
+        """Finish all the resource reloads in progress, right now."""
+        while self._reload_jobs:
+            job = self._reload_jobs.pop(0)
+            job.run(None)
+            self._resources_reloaded(job)
+
+    def _resources_reloaded(self, job):
+        self.perf.end_reload()
+        self._latency.applied([('resource', fname) for fname in job.changed])
+        self.dirty_regions = job.dirty
         # inform the program we have reloaded some resources
-        if changed and hasattr(self.app, 'reload_resources'):
+        if job.changed and hasattr(self.app, 'reload_resources'):
             reload_resources = getattr(self.app, 'reload_resources')
             if reload_resources:
                 reload_resources(self.load_list)
 
+    def _find_changes(self, batch=None):
+        """Return (changed module names, {changed resource file: _FileStamp}).
 
-    def _check_for_module_updates(self):
-        """Reload any module whose source file changed, return True if any did."""
-        reloaded = False
-        for (mname, mtime) in list(self.mstats.items()):
-            m = sys.modules.get(mname)
-            new_mtime = self._get_module_mtime(m)
-            if new_mtime > mtime:
-                self.mstats[mname] = new_mtime
-                importlib.reload(m)
-                reloaded = True
-        return reloaded
+        With a batch of (module names, resource files, directory watches),
+        only those are checked (see _PollScheduler)."""
+        self.trace.begin('scan')
+        start = time.perf_counter()
+        # None means "anything may have changed"
+        candidates = self._backend.changed_paths() if batch is None else None
+        (only_modules, only_files, only_directories) = batch or (None, None, None)
+        modules = []
+        resources = {}
+        if self.hotreload_code:
+            modules = self._find_module_changes(candidates, only_modules)
+        if self.hotreload_resources:
+            resources = self._find_resource_changes(candidates, only_files)
+            resources.update(self._find_directory_changes(candidates, only_directories))
+        self.last_scan_time = time.perf_counter() - start
+        self.scan_time_total += self.last_scan_time
+        self.scan_count += 1
+        self.trace.end('scan')
+        return (modules, resources)
+
+    def _collect_changes(self, changes=None):
+        """Look for changes in all the files (unless given), and return
+        (modules, resources) to reload once they have settled. Until then,
+        returns nothing to reload."""
+        if changes is None:
+            start = time.monotonic()
+            changes = self._find_changes()
+            self._scheduler.scanned(start, *changes)
+        (modules, resources) = changes
+        now = time.monotonic()
+        self._pending.add(modules, resources, now)
+        # We also wait until we looked at all the files after they settled,
+        # in case some of them changed too (see _PollScheduler).
+        if self._pending.settled(now, self.settle_time) \
+                and self._scheduler.caught_up(self._pending.last_change + self.settle_time):
+            return self._pending.commit()
+        return ([], {})
+
+    def _apply_changes(self, modules, resources):
+        """Reload the changed modules and resources."""
+        # hotreload code, if needed. It's compiled on the compiler thread
+        # first, see _finish_compiling.
+        if modules:
+            self._to_compile += [m for m in modules if m not in self._to_compile]
+            self._start_compiling()
+        # hotreload resources, if needed
+        if resources and self.decode_in_background:
+            self._to_decode.update(resources)
+            self._start_decoding()
+        elif resources:
+            self._reload_resources(resources)
+
+    def _start_decoding(self):
+        """Start decoding the changed resources on the decoder thread,
+        unless it's already busy."""
+        if self._decoding or not self._to_decode: return
+        if self._decoder is None:
+            self._decoder = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='reloadpyxel-decoder')
+        changed = self._to_decode
+        self._to_decode = {}
+        commands = [command for command in self.load_list if command.filename() in changed]
+        self._decoding = (self._decoder.submit(_prepare_all, commands), changed)
+
+    def _finish_decoding(self):
+        """If the decoder thread is done, apply what it decoded, all in this frame."""
+        if not self._decoding or not self._decoding[0].done(): return
+        (future, changed) = self._decoding
+        self._decoding = None
+        self._reload_resources(changed, future.result())
+        self._start_decoding()
+
+    def _start_compiling(self):
+        """Start compiling the changed modules, and the modules that import
+        them, on the compiler thread, unless it's already busy."""
+        if self._compiling or not self._to_compile: return
+        changed = self._to_compile
+        self._to_compile = []
+        paths = {mname: self._get_module_source(sys.modules.get(mname)) for mname in self.imports}
+        future = self._compiler_pool().submit(_compile_all, changed, paths, dict(self.imports))
+        self._compiling = (future, changed)
+
+    def _compiler_pool(self):
+        if self._compiler is None:
+            self._compiler = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='reloadpyxel-compiler')
+        return self._compiler
+
+    def _finish_compiling(self):
+        """If the compiler thread is done, run the new code of the modules,
+        and renew the app if its module was one of them."""
+        if not self._compiling or not self._compiling[0].done(): return
+        (future, changed) = self._compiling
+        self._compiling = None
+        try:
+            (order, compiled) = future.result()
+        except (OSError, SyntaxError, ValueError) as e:
+            # Leave the game as it is: it'll be reloaded once the file is fixed.
+            self.code_error = ''.join(traceback.format_exception_only(type(e), e))
+            print('Not reloading code:', self.code_error, end='')
+            self._latency.discard([('code', mname) for mname in changed])
+            self._start_compiling()
+            return
+        with self._lock:
+            stale = [mname for (mname, (digest, _code, _imports)) in compiled.items()
+                     if mname in self.mstats and self.mstats[mname].digest != digest]
+        if stale:
+            # Changed again while we compiled, compile it all again.
+            self._to_compile += [m for m in changed if m not in self._to_compile]
+        elif self.patch_functions and self._patch_modules(changed, compiled):
+            # Only function bodies changed, and we put the new code in place.
+            self.code_error = None
+            self.perf.end_reload()
+            self._latency.applied([('code', mname) for mname in changed])
+        else:
+            self.code_error = None
+            old_classes = {mname: _module_classes(sys.modules[mname]) for mname in order}
+            self._reload_modules(order, compiled)
+            if self.migrate_instances:
+                start = time.perf_counter()
+                _migrate_instances(self.app, old_classes, set(self.imports))
+                self.perf.add_reload_part('(migrate)', time.perf_counter() - start)
+            # The app only needs a new instance if its own module was reloaded.
+            if self.app.__module__ in order:
+                start = time.perf_counter()
+                self._renew_app()
+                self.perf.add_reload_part('(new App)', time.perf_counter() - start)
+            self.perf.end_reload()
+            self._latency.applied([('code', mname) for mname in changed])
+        self._start_compiling()
+
+    def _reload_modules(self, order, compiled):
+        """Run the compiled code of the modules, in that order, and return
+        their names.
+
+        Like importlib.reload, this runs the new code in the module's
+        existing namespace. But it never looks at .pyc files, which can
+        be stale when a file changes twice within the same second."""
+        for mname in order:
+            (_digest, code, imports) = compiled[mname]
+            start = time.perf_counter()
+            self.trace.begin('module.exec', mname)
+            exec(code, sys.modules[mname].__dict__)
+            self.trace.end('module.exec')
+            self.perf.add_reload_part(mname, time.perf_counter() - start)
+            self.imports[mname] = imports
+            self._module_code[mname] = code
+        return order
+
+    def _patch_modules(self, changed, compiled):
+        """If only function bodies changed in the changed modules, put the new
+        code into their functions and return True. Otherwise change nothing
+        and return False: they need a full reload."""
+        if self._baseline:
+            # The compiler thread does one thing at a time, so it's done by now.
+            (future, digests) = self._baseline
+            self._baseline = None
+            for (mname, (digest, code, _imports)) in future.result().items():
+                if digests.get(mname) == digest: self._module_code.setdefault(mname, code)
+        patches = []
+        for mname in changed:
+            if mname not in compiled or mname not in self._module_code: return False
+            module_patches = _function_patches(sys.modules[mname], self._module_code[mname], compiled[mname][1])
+            if module_patches is None: return False
+            patches += module_patches
+        start = time.perf_counter()
+        for (function, code) in patches:
+            function.__code__ = code
+        self.perf.add_reload_part('(patch)', time.perf_counter() - start)
+        for mname in changed:
+            self._module_code[mname] = compiled[mname][1]
+        return True
+
+    def _apply_background_changes(self):
+        """Reload whatever the watcher thread found since the last frame."""
+        modules = []
+        resources = {}
+        while True:
+            try:
+                (changed_modules, changed_resources) = self.changes.get_nowait()
+            except queue.Empty:
+                break
+            modules += [m for m in changed_modules if m not in modules]
+            resources.update(changed_resources)
+        self._apply_changes(modules, resources)
 
     def _renew_app(self):
         """Called after we reloaded the module and created a new instance of App."""
@@ -175,33 +813,1169 @@ class ReloadPyxel:
         m = sys.modules.get(mname)
         # We require the main app class be called "App"
         class_name = self.app.__class__.__name__
+        self.trace.begin('_renew_app')
         # Create a new instance
         new_app = getattr(m, class_name)(self)
         # Call it so it can transfer state
         new_app.reload(self.app)
         self.app = new_app
+        self.trace.end('_renew_app')
 
     def _update(self):
         """Called every frame, forwards to the game's update but also
         checks for updates to resources or source files."""
-        self.ticks += 1
-        if (self.ticks%self.check_period==0):
-            self.ticks = 0
-            # hotreload code, if needed
-            if self.hotreload_code:
-                reloaded = self._check_for_module_updates()
-                if reloaded:
-                    self._renew_app()
-            # hotreload resources, if needed
-            if self.hotreload_resources:
-                self._check_for_resource_updates()
+        self.trace.begin('_update')
+        self.perf.frame_started(time.perf_counter())
+        if self.hud_key is not None and pyxel.btnp(self.hud_key):
+            self.show_hud = not self.show_hud
+        if self._compiling:
+            self._finish_compiling()
+        if self.decode_in_background:
+            self._finish_decoding()
+        if self._reload_jobs:
+            self._run_reload_jobs()
+        if self._watcher:
+            # The watcher thread did the checking for us.
+            self._apply_background_changes()
+        else:
+            # Check what's due this frame. While changes are settling, this
+            # runs every frame so we can reload as soon as they're done.
+            changes = self._scheduler.step(self, time.monotonic())
+            if changes[0] or changes[1] or self._pending.waiting():
+                self._apply_changes(*self._collect_changes(changes))
+        start = time.perf_counter()
         self.app.update()
+        self.perf.update_times.append(time.perf_counter() - start)
+        self.trace.end('_update')
 
     def _draw(self):
         """Called every frame, forwards to the game's draw."""
         # We do this instead of passing draw to pyxel.run because
         # self.app may change in case of hot reload.
+        self.trace.begin('_draw')
+        start = time.perf_counter()
         self.app.draw()
+        self.perf.draw_times.append(time.perf_counter() - start)
+        if self.show_hud:
+            self._draw_hud()
+        self._latency.drawn()
+        self.trace.end('_draw')
+
+    def _draw_hud(self):
+        lines = self.hud_lines()
+        width = max(len(line) for line in lines) * 4 + 3
+        pyxel.rect(1, 1, width, len(lines) * 6 + 3, 0)
+        for (i, line) in enumerate(lines):
+            pyxel.text(3, 3 + i * 6, line, 7)
+
+
+class _PerfStats:
+    """Timings for the HUD, over the last few frames."""
+    def __init__(self, frames=120):
+        # In seconds: from one frame to the next, and the app's update and draw.
+        self.frame_times = collections.deque(maxlen=frames)
+        self.update_times = collections.deque(maxlen=frames)
+        self.draw_times = collections.deque(maxlen=frames)
+        self._frame_start = None
+        # What the reload in progress spent time on, by command or module.
+        self.reload_parts = {}
+        # The last reload: (total seconds, [(what, seconds)], slowest first).
+        self.last_reload = (0.0, [])
+
+    def frame_started(self, now):
+        if self._frame_start is not None:
+            self.frame_times.append(now - self._frame_start)
+        self._frame_start = now
+
+    def add_reload_part(self, name, seconds):
+        self.reload_parts[name] = self.reload_parts.get(name, 0.0) + seconds
+
+    def end_reload(self):
+        parts = sorted(self.reload_parts.items(), key=lambda part: -part[1])
+        self.last_reload = (sum(seconds for (_name, seconds) in parts), parts)
+        self.reload_parts = {}
+
+
+class _LatencyTracker:
+    """Follows each changed file from its modification time to the first
+    frame drawn after it was reloaded. Times are wall clock nanoseconds,
+    like file modification times."""
+    def __init__(self):
+        self.stages = {stage: _Histogram() for stage in ('detect', 'apply', 'draw', 'total')}
+        # (kind, name) -> (modification time, when we noticed)
+        self._detected = {}
+        # (modification time, when we noticed, when it was reloaded)
+        self._applied = []
+        # detected() is also called from the watcher thread.
+        self._lock = threading.Lock()
+
+    def detected(self, key, mtime_ns):
+        with self._lock:
+            self._detected[key] = (mtime_ns, time.time_ns())
+
+    def applied(self, keys):
+        now = time.time_ns()
+        with self._lock:
+            for key in keys:
+                if key in self._detected:
+                    self._applied.append(self._detected.pop(key) + (now,))
+
+    def discard(self, keys):
+        with self._lock:
+            for key in keys:
+                self._detected.pop(key, None)
+
+    def drawn(self):
+        if not self._applied: return
+        now = time.time_ns()
+        for (mtime, detected, applied) in self._applied:
+            # The clocks of network drives can be off: don't go below zero.
+            self.stages['detect'].add(max(detected - mtime, 0))
+            self.stages['apply'].add(applied - detected)
+            self.stages['draw'].add(now - applied)
+            self.stages['total'].add(max(now - mtime, 0))
+        self._applied = []
+
+    def histograms(self):
+        return {stage: histogram.report() for (stage, histogram) in self.stages.items()}
+
+
+class _Histogram:
+    """Counts durations in buckets that grow about 2x at a time."""
+    BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, nanoseconds):
+        ms = nanoseconds / 1e6
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def report(self):
+        return {'count': self.count,
+                'mean_ms': self.total_ms / self.count if self.count else 0.0,
+                'max_ms': self.max_ms,
+                'buckets': list(zip(self.BOUNDS_MS, self.counts))}
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def _average(values):
+    return sum(values) / len(values) if values else 0.0
+
+
+class _TraceRecorder:
+    """Records begin and end events in memory, and a thread writes them to
+    the trace file every flush_interval seconds. If the thread falls behind,
+    the oldest events are dropped rather than slowing down the game."""
+    def __init__(self, filename, capacity=1 << 16, flush_interval=0.5):
+        self.filename = filename
+        self.jsonl = filename.endswith('.jsonl')
+        # (phase, name, detail, microseconds, thread id)
+        self.events = collections.deque(maxlen=capacity)
+        self.pid = os.getpid()
+        self._file = open(filename, 'w', encoding='utf-8')
+        if not self.jsonl:
+            # Chrome reads a trace whose array was never closed.
+            self._file.write('[\n')
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(flush_interval,),
+                                        name='reloadpyxel-trace', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def begin(self, name, detail=None):
+        self.events.append(('B', name, detail, time.perf_counter_ns() // 1000, threading.get_ident()))
+
+    def end(self, name):
+        self.events.append(('E', name, None, time.perf_counter_ns() // 1000, threading.get_ident()))
+
+    def _run(self, flush_interval):
+        while not self._stop_event.wait(flush_interval):
+            self.flush()
+
+    def flush(self):
+        lines = []
+        while True:
+            try:
+                (phase, name, detail, ts, tid) = self.events.popleft()
+            except IndexError:
+                break
+            event = {'name': name, 'ph': phase, 'ts': ts, 'pid': self.pid, 'tid': tid}
+            if detail is not None: event['args'] = {'detail': detail}
+            lines.append(json.dumps(event) + ('\n' if self.jsonl else ',\n'))
+        if not lines: return
+        with self._lock:
+            if self._file.closed: return
+            self._file.writelines(lines)
+            self._file.flush()
+
+    def close(self):
+        self._stop_event.set()
+        self.flush()
+        with self._lock:
+            self._file.close()
+
+
+class _NullTrace:
+    """What we record to when there's no trace file."""
+    def begin(self, name, detail=None):
+        pass
+    def end(self, name):
+        pass
+
+_NO_TRACE = _NullTrace()
+
+
+class _WatcherThread(threading.Thread):
+    """Looks for changed files in the background and queues them
+    for the game thread."""
+    def __init__(self, repyxel):
+        super().__init__(name='reloadpyxel-watcher', daemon=True)
+        self.repyxel = repyxel
+        self._stop_event = threading.Event()
+
+    def run(self):
+        repyxel = self.repyxel
+        while not self._stop_event.wait(self._interval()):
+            (modules, resources) = repyxel._collect_changes()
+            if modules or resources:
+                repyxel.changes.put((modules, resources))
+
+    def _interval(self):
+        """How long to wait before the next check."""
+        repyxel = self.repyxel
+        interval = repyxel._scheduler.interval()
+        if repyxel._pending.waiting():
+            return min(interval, repyxel.settle_time / 2)
+        return interval
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class _PollScheduler:
+    """Decides when to look for changes.
+
+    Code and resources each have their own cadence (see _PollCadence). When
+    the backend polls, a check of all the files (a pass) is spread over
+    several frames: each frame checks at most batch_size of them, so no
+    frame has to pay for checking everything.
+
+    While changes are settling, we look every frame: at the changed files
+    (to see if they're still changing), and at the next batch of the pass.
+    They're only reloaded once a whole pass started after they settled,
+    so we don't miss other files saved at the same time (see caught_up)."""
+    def __init__(self, assets_interval, code_interval, max_interval, batch_size):
+        self.assets = _PollCadence(assets_interval, max_interval)
+        self.code = _PollCadence(code_interval, max_interval)
+        self.batch_size = batch_size
+
+    def interval(self):
+        """How long until the next check, for the watcher thread."""
+        return min(self.assets.interval, self.code.interval)
+
+    def scanned(self, start, modules, resources):
+        """Adapt after a full check, started at 'start', that found these changes."""
+        self.code.pass_done(start, bool(modules))
+        self.assets.pass_done(start, bool(resources))
+
+    def caught_up(self, since):
+        """True if every file was checked in a pass started at 'since' or later."""
+        return all(cadence.checked_since is not None and cadence.checked_since >= since
+                   for cadence in (self.code, self.assets))
+
+    def step(self, repyxel, now):
+        """Check what's due this frame, return (modules, resources) that changed."""
+        pending = repyxel._pending
+        settling = pending.waiting()
+        active = [cadence for cadence in (self.code, self.assets) if settling or cadence.due(now)]
+        if not active: return ([], {})
+        if not isinstance(repyxel._backend, _PollingBackend):
+            # The backend tells us what changed, so a check is cheap: do it all.
+            changes = repyxel._find_changes()
+            self.scanned(now, *changes)
+            return changes
+        # Code and resources share the batch, and either can use what the other leaves.
+        share = max(1, self.batch_size // len(active))
+        modules = self.code.take(now, lambda: list(repyxel.mstats), share) if self.code in active else []
+        assets = self.assets.take(now, lambda: list(repyxel.fstats) + list(repyxel.directories),
+                                  max(1, self.batch_size - len(modules))) if self.assets in active else []
+        files = [item for item in assets if isinstance(item, str)]
+        directories = [item for item in assets if not isinstance(item, str)]
+        if settling:
+            # Also the files that are settling, wherever the pass is.
+            modules = list(dict.fromkeys(modules + list(pending.modules)))
+            files = list(dict.fromkeys(files + [fname for fname in pending.resources if fname in repyxel.fstats]))
+            directories += [watch for watch in repyxel.directories if watch not in directories
+                            and any(watch.owns(fname) for fname in pending.resources)]
+        changes = repyxel._find_changes((modules, files, directories))
+        self.code.batch_done(bool(changes[0]))
+        self.assets.batch_done(bool(changes[1]))
+        return changes
+
+
+class _PollCadence:
+    """How often to check one kind of file. Right after a change, every
+    min_interval seconds. Each check that finds nothing doubles the
+    interval, up to max_interval."""
+    def __init__(self, min_interval, max_interval):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min_interval
+        self.next_pass = 0.0
+        # What's left to check in the pass in progress (or None), and when it started.
+        self.todo = None
+        self.pass_start = None
+        self.found = False
+        # When the last complete pass started: every file was checked since then.
+        self.checked_since = None
+
+    def due(self, now):
+        return self.todo is not None or now >= self.next_pass
+
+    def take(self, now, items, count):
+        """Return up to 'count' things to check now. Starts a new pass
+        (with the list from items()) if none is in progress."""
+        if self.todo is None:
+            self.todo = collections.deque(items())
+            self.pass_start = now
+            self.found = False
+        return [self.todo.popleft() for _ in range(min(count, len(self.todo)))]
+
+    def batch_done(self, found):
+        self.found = self.found or found
+        if self.todo is not None and not self.todo:
+            self.todo = None
+            self.pass_done(self.pass_start, self.found)
+
+    def pass_done(self, start, found):
+        if found:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        self.next_pass = start + self.interval
+        self.checked_since = start
+
+
+class _DirectoryWatch:
+    """The files matching a pattern in a directory and its subdirectories.
+
+    A directory is only listed again (with os.scandir) when its modification
+    time changed, which is when files were created, deleted or renamed in it.
+    Otherwise we only check the files we already know about. With inotify,
+    directories where nothing happened aren't even looked at."""
+    def __init__(self, path, pattern, loader, backend):
+        self.path = os.path.abspath(path)
+        self.pattern = pattern
+        self.loader = loader
+        self.backend = backend
+        # directory -> (its mtime_ns, {file path: _FileStamp})
+        self.dirs = {}
+        self._list(self.path, {})
+
+    def files(self):
+        return sorted(fname for (_mtime, files) in self.dirs.values() for fname in files)
+
+    def owns(self, fname):
+        return (fname.startswith(os.path.join(self.path, ''))
+                and fnmatch.fnmatch(os.path.basename(fname), self.pattern))
+
+    def scan(self, candidates=None):
+        """Return {filename: _FileStamp, or None if it was deleted} for the
+        files that were created, changed or deleted since the last scan."""
+        changed = {}
+        for directory in list(self.dirs):
+            if directory not in self.dirs: continue  # Went away with its parent.
+            if candidates is not None and directory not in candidates: continue
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if mtime_ns != self.dirs[directory][0]:
+                self._list(directory, changed)
+                continue
+            for (fname, stamp) in self.dirs[directory][1].items():
+                try:
+                    new_stamp = _restamp(fname, stamp)
+                except OSError:
+                    continue
+                if new_stamp is None: continue
+                self.dirs[directory][1][fname] = new_stamp
+                if new_stamp.digest != stamp.digest: changed[fname] = new_stamp
+        return changed
+
+    def _list(self, directory, changed):
+        """List the directory again, and add what changed in it to 'changed'."""
+        (_mtime, old_files) = self.dirs.pop(directory, (None, {}))
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            # It was deleted, and so were its files and subdirectories.
+            for fname in old_files: changed[fname] = None
+            for subdirectory in [d for d in self.dirs if d.startswith(os.path.join(directory, ''))]:
+                for fname in self.dirs.pop(subdirectory)[1]: changed[fname] = None
+                self.backend.unwatch_directory(subdirectory)
+            if directory == self.path:
+                # Keep looking at it, in case it comes back.
+                self.dirs[directory] = (None, {})
+            else:
+                self.backend.unwatch_directory(directory)
+            return
+        self.backend.watch_directory(directory)
+        files = {}
+        subdirectories = set()
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.add(entry.path)
+                if entry.path not in self.dirs:
+                    self._list(entry.path, changed)
+            elif entry.is_file() and fnmatch.fnmatch(entry.name, self.pattern):
+                stamp = old_files.get(entry.path)
+                try:
+                    # On Windows, scandir already knows this.
+                    st = entry.stat()
+                    if stamp and stamp.size == st.st_size and stamp.mtime_ns == st.st_mtime_ns:
+                        files[entry.path] = stamp
+                        continue
+                    new_stamp = _FileStamp(st.st_size, st.st_mtime_ns, _file_digest(entry.path))
+                except OSError:
+                    continue
+                files[entry.path] = new_stamp
+                if stamp is None or stamp.digest != new_stamp.digest:
+                    changed[entry.path] = new_stamp
+        for fname in old_files:
+            if fname not in files: changed[fname] = None
+        for subdirectory in [d for d in self.dirs if os.path.dirname(d) == directory and d not in subdirectories]:
+            # Deleted or renamed.
+            self._list(subdirectory, changed)
+        self.dirs[directory] = (mtime_ns, files)
+
+
+class _ReloadTransaction:
+    """Changes that will be reloaded together.
+
+    Every time we find that some files changed, we add them here. Once
+    none of them changed for a while (the files have "settled"), we commit:
+    everything is reloaded at once, with a single pass over the load list
+    and at most one new App."""
+    def __init__(self):
+        self.modules = {}
+        self.resources = {}
+        # When we last saw any of these files change
+        self.last_change = None
+
+    def add(self, modules, resources, now):
+        if not modules and not resources: return
+        for mname in modules:
+            self.modules[mname] = True
+        self.resources.update(resources)
+        self.last_change = now
+
+    def waiting(self):
+        return self.last_change is not None
+
+    def settled(self, now, settle_time):
+        return self.waiting() and now - self.last_change >= settle_time
+
+    def commit(self):
+        """Return (modules, resources) and start a new transaction."""
+        changes = (list(self.modules), self.resources)
+        self.__init__()
+        return changes
+
+
+# What we know about a watched file. We only look at the contents (digest)
+# when the size or modification time changed.
+_FileStamp = collections.namedtuple('_FileStamp', ['size', 'mtime_ns', 'digest'])
+
+# Files at least this big are hashed through mmap instead of being read in.
+_MMAP_THRESHOLD = 1 << 20
+
+
+def _file_digest(filename):
+    """Return a hash of the file's contents."""
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < _MMAP_THRESHOLD:
+            return hashlib.blake2b(f.read(), digest_size=16).digest()
+        # No copy into Python memory, and hashlib lets go of the GIL
+        # while it works so the game thread can keep going.
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return hashlib.blake2b(mapped, digest_size=16).digest()
+        except ValueError:
+            # The file was emptied since we looked at its size (an
+            # editor mid-save): mmap can't map an empty file.
+            f.seek(0)
+            return hashlib.blake2b(f.read(), digest_size=16).digest()
+
+
+def _restamp(filename, stamp=None):
+    """Return a new _FileStamp for the file, or None if its size and
+    modification time still match 'stamp'."""
+    st = os.stat(filename)
+    if stamp and stamp.size == st.st_size and stamp.mtime_ns == st.st_mtime_ns:
+        return None
+    return _FileStamp(st.st_size, st.st_mtime_ns, _file_digest(filename))
+
+
+def _module_classes(module):
+    """Return {name: class} for the classes defined at the top of the module."""
+    return {name: value for (name, value) in vars(module).items()
+            if isinstance(value, type) and value.__module__ == module.__name__}
+
+
+def _migrate_instances(app, old_classes, mnames):
+    """Switch the objects reachable from the app to the new version of
+    their class, for the modules that were reloaded.
+
+    'old_classes' is {module name: _module_classes(module)} from before the
+    reload, and 'mnames' the modules we watch: we look inside the objects
+    of their classes, and inside lists, tuples, sets and dicts. Each object
+    is visited once. If the new class has a "reload_instance(self, old_class)"
+    method, it's called on each migrated object, to fix up its state.
+    If the class can't be switched because the layout changed (different
+    __slots__), a new object gets the old one's state and takes its place
+    in attributes, lists and dict values (not in tuples, sets or dict keys).
+    The app itself is left alone: it gets a new instance (see _renew_app)."""
+    new_classes = {}
+    for (mname, classes) in old_classes.items():
+        module = sys.modules[mname]
+        for (name, old_class) in classes.items():
+            new_class = getattr(module, name, None)
+            if isinstance(new_class, type) and new_class is not old_class:
+                new_classes[old_class] = new_class
+    if not new_classes: return
+    seen = {id(app)}
+    # id(old object) -> the new object that replaces it, for objects whose
+    # class can't just be switched. We keep the old ones so ids aren't reused.
+    replaced = {}
+    kept = []
+    todo = [app]
+    while todo:
+        obj = todo.pop()
+        setter = None
+        if isinstance(obj, dict):
+            children = list(obj.items())
+            # Keys can't be replaced, only switched.
+            children += [(_NO_KEY, key) for key in obj]
+            setter = obj.__setitem__
+        elif isinstance(obj, (list, collections.deque)):
+            children = list(enumerate(obj))
+            setter = obj.__setitem__
+        elif isinstance(obj, (tuple, set, frozenset)):
+            children = [(_NO_KEY, child) for child in obj]
+        elif type(obj).__module__ in mnames:
+            (has_dict, slots) = _field_plan(type(obj))
+            children = list(obj.__dict__.items()) if has_dict else []
+            children += [(slot, getattr(obj, slot)) for slot in slots if hasattr(obj, slot)]
+            setter = functools.partial(object.__setattr__, obj)
+        else:
+            continue
+        for (key, child) in children:
+            if id(child) in replaced:
+                if setter and key is not _NO_KEY: setter(key, replaced[id(child)])
+                continue
+            if id(child) in seen: continue
+            seen.add(id(child))
+            old_class = type(child)
+            if old_class in new_classes:
+                new_child = _migrate_instance(child, new_classes[old_class])
+                if new_child is not child:
+                    replaced[id(child)] = new_child
+                    kept.append(child)
+                    seen.add(id(new_child))
+                    if setter and key is not _NO_KEY: setter(key, new_child)
+                reload_instance = getattr(new_child, 'reload_instance', None)
+                if reload_instance: reload_instance(old_class)
+                child = new_child
+            todo.append(child)
+    _FIELD_PLANS.clear()
+    _TRANSFER_PLANS.clear()
+
+
+# For what can't be put back where it was found: set members, tuple items, dict keys.
+_NO_KEY = object()
+
+
+def _migrate_instance(obj, new_class):
+    """Return the object switched to the new class, or if their layouts
+    differ (__slots__ changed, for example), a new object with its state."""
+    if isinstance(obj, enum.Enum) and issubclass(new_class, enum.Enum):
+        # Each member exists once: take the new class's member of that name.
+        return new_class.__members__.get(obj.name, obj)
+    try:
+        obj.__class__ = new_class
+        return obj
+    except TypeError:
+        return copy_all_attributes(obj, new_class.__new__(new_class))
+
+
+# class -> (whether its objects have a __dict__, the names of their slots)
+_FIELD_PLANS = {}
+# (source class, destination class) -> what copy_all_attributes does, see _transfer_plan
+_TRANSFER_PLANS = {}
+
+
+def _field_plan(cls):
+    plan = _FIELD_PLANS.get(cls)
+    if plan is None:
+        plan = _FIELD_PLANS[cls] = (cls.__dictoffset__ != 0, tuple(_slot_names(cls)))
+    return plan
+
+
+def _transfer_plan(source_class, dest_class):
+    """Return how to copy the attributes of a source_class object to a
+    dest_class object: (copy the whole __dict__, names in the source's
+    __dict__ that go to slots of the destination, slots to copy)."""
+    plan = _TRANSFER_PLANS.get((source_class, dest_class))
+    if plan is None:
+        (source_dict, source_slots) = _field_plan(source_class)
+        (dest_dict, dest_slots) = _field_plan(dest_class)
+        copy_dict = source_dict and dest_dict
+        dict_to_slots = frozenset(dest_slots) if source_dict and not dest_dict else frozenset()
+        slots = tuple(name for name in source_slots if dest_dict or name in dest_slots)
+        plan = _TRANSFER_PLANS[(source_class, dest_class)] = (copy_dict, dict_to_slots, slots)
+    return plan
+
+
+def _slot_names(cls):
+    """Return the names of the attributes kept in __slots__ by the class and its bases."""
+    names = []
+    for base in cls.__mro__:
+        slots = base.__dict__.get('__slots__', ())
+        if isinstance(slots, str): slots = [slots]
+        for slot in slots:
+            if slot in ('__dict__', '__weakref__'): continue
+            if slot.startswith('__') and not slot.endswith('__'):
+                # Private names are mangled.
+                slot = '_' + base.__name__.lstrip('_') + slot
+            names.append(slot)
+    return names
+
+
+def _function_patches(module, old_code, new_code):
+    """Compare the old and new code of the module. If only the bodies of its
+    functions and methods changed, return [(function, its new code)].
+    Return None if something else changed: a new class or function, a changed
+    signature, default value, decorator or class attribute, and so on."""
+    if _code_shape(old_code) != _code_shape(new_code): return None
+    functions = _live_functions(module)
+    patches = []
+    for (qualname, codes) in _function_codes(new_code).items():
+        targets = functions.get(qualname, [])
+        if len(targets) != len(codes): return None
+        for (function, code) in zip(targets, codes):
+            # If a decorator wrapped the function, it's not the one to patch.
+            if function.__code__.co_name != code.co_name: return None
+            if function.__code__.co_freevars != code.co_freevars: return None
+            if function.__code__ is not code: patches.append((function, code))
+    return patches
+
+
+def _is_function_code(code):
+    # Class bodies and modules don't get fresh locals, functions do.
+    return bool(code.co_flags & 0x2) and not code.co_name.startswith('<')
+
+
+def _code_shape(code):
+    """Everything about the code of a module or class body, except the bodies
+    of the functions it defines. Lambdas and comprehensions are included whole."""
+    consts = []
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType) and _is_function_code(const):
+            consts.append(('function', const.co_name, const.co_argcount, const.co_posonlyargcount,
+                           const.co_kwonlyargcount, const.co_varnames[:_arg_count(const)],
+                           const.co_flags, const.co_freevars))
+        elif isinstance(const, types.CodeType):
+            consts.append(_code_shape(const))
+        elif '__firstlineno__' in code.co_names and const == code.co_firstlineno:
+            # The line a class starts on moves when code above it grows.
+            consts.append('__firstlineno__')
+        else:
+            consts.append((type(const), const))
+    return (code.co_name, code.co_code, code.co_names, code.co_varnames, code.co_freevars,
+            code.co_cellvars, code.co_flags, tuple(consts))
+
+
+def _arg_count(code):
+    count = code.co_argcount + code.co_kwonlyargcount
+    if code.co_flags & 0x4: count += 1  # *args
+    if code.co_flags & 0x8: count += 1  # **kwargs
+    return count
+
+
+def _function_codes(code, prefix=''):
+    """Return {qualified name: [code]} for the functions defined directly in
+    the module or class body, and in the classes it defines."""
+    codes = collections.defaultdict(list)
+    for const in code.co_consts:
+        if not isinstance(const, types.CodeType): continue
+        if _is_function_code(const):
+            codes[prefix + const.co_name].append(const)
+        elif not const.co_name.startswith('<'):
+            # A class body.
+            for (qualname, class_codes) in _function_codes(const, prefix + const.co_name + '.').items():
+                codes[qualname] += class_codes
+    return codes
+
+
+def _live_functions(module):
+    """Return {qualified name: [function]} for the functions and methods of
+    the module, in the order they're found."""
+    functions = collections.defaultdict(list)
+    def add(value):
+        if isinstance(value, (staticmethod, classmethod)):
+            value = value.__func__
+        if isinstance(value, property):
+            for accessor in (value.fget, value.fset, value.fdel):
+                if accessor is not None: add(accessor)
+        elif isinstance(value, types.FunctionType) and value.__module__ == module.__name__:
+            if value not in functions[value.__qualname__]: functions[value.__qualname__].append(value)
+        elif isinstance(value, type) and value.__module__ == module.__name__ and value not in seen:
+            seen.add(value)
+            for attribute in vars(value).values(): add(attribute)
+    seen = set()
+    for value in vars(module).values(): add(value)
+    return functions
+
+
+def _compile_all(changed, paths, imports):
+    """Compile the changed modules and the modules that import them.
+
+    Returns (the order to run them in, {module name: (digest of the source,
+    code, names it imports)}). This runs on the compiler thread, so it only
+    reads the arguments it's given. Raises SyntaxError for broken code."""
+    imports = dict(imports)
+    compiled = {}
+    for mname in changed:
+        if not paths.get(mname): continue
+        compiled[mname] = _compile_module(mname, paths[mname])
+        imports[mname] = compiled[mname][2]
+    order = _reload_order([mname for mname in changed if mname in compiled], imports)
+    for mname in order:
+        if mname not in compiled:
+            compiled[mname] = _compile_module(mname, paths[mname])
+    return (order, compiled)
+
+
+def _compile_sources(paths):
+    """Return {module name: _compile_module(...)} for the modules we can compile."""
+    compiled = {}
+    for (mname, path) in paths.items():
+        try:
+            compiled[mname] = _compile_module(mname, path)
+        except (OSError, SyntaxError, ValueError):
+            continue
+    return compiled
+
+
+def _compile_module(mname, path):
+    """Return (digest of the source, code, names it imports) for the module's source."""
+    with open(path, 'rb') as f:
+        source = f.read()
+    tree = ast.parse(source, path)
+    code = compile(tree, path, 'exec', dont_inherit=True)
+    return (hashlib.blake2b(source, digest_size=16).digest(), code, _tree_imports(mname, path, tree))
+
+
+def _module_imports(mname, path):
+    """Return the names of the modules the module's source imports
+    (and of their parent packages), or an empty set if we can't read it."""
+    try:
+        with open(path, 'rb') as f:
+            tree = ast.parse(f.read(), path)
+    except (OSError, SyntaxError, ValueError):
+        return set()
+    return _tree_imports(mname, path, tree)
+
+
+def _tree_imports(mname, path, tree):
+    """Return the names of the modules imported in the module's syntax tree."""
+    is_package = os.path.splitext(os.path.basename(path))[0] == '__init__'
+    package = mname if is_package else mname.rpartition('.')[0]
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                # Relative import: go up (level - 1) packages from ours.
+                parts = package.split('.') if package else []
+                if node.level - 1 > len(parts): continue
+                parent = '.'.join(parts[:len(parts) - (node.level - 1)])
+                base = parent + '.' + base if base and parent else base or parent
+            if not base: continue
+            names.add(base)
+            # "from package import module" imports the module too.
+            names.update(base + '.' + alias.name for alias in node.names)
+    imports = set()
+    for name in names:
+        parts = name.split('.')
+        imports.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    imports.discard(mname)
+    return imports
+
+
+def _reload_order(changed, imports):
+    """Return the changed modules and all the modules that import them,
+    directly or not, each after the modules it imports.
+
+    'imports' maps each module we watch to the names it imports. Modules
+    that import each other (a cycle) are reloaded in the order we watch them."""
+    importers = collections.defaultdict(list)
+    for (mname, names) in imports.items():
+        for name in names:
+            if name in imports: importers[name].append(mname)
+    affected = set()
+    todo = [mname for mname in changed if mname in imports]
+    while todo:
+        mname = todo.pop()
+        if mname in affected: continue
+        affected.add(mname)
+        todo += importers[mname]
+    # Topological sort of the affected modules.
+    waiting_on = {mname: len(imports[mname] & affected) for mname in affected}
+    ready = [mname for mname in imports if mname in affected and not waiting_on[mname]]
+    order = []
+    while len(order) < len(affected):
+        if not ready:
+            # A cycle: break it with the first module we haven't done yet.
+            ready = [next(mname for mname in imports if mname in affected and mname not in order)]
+            waiting_on[ready[0]] = 0
+        mname = ready.pop(0)
+        if mname in order: continue
+        order.append(mname)
+        for importer in importers[mname]:
+            if importer not in affected or importer in order: continue
+            waiting_on[importer] -= 1
+            if waiting_on[importer] == 0: ready.append(importer)
+    return order
+
+
+def _make_watcher_backend(kind):
+    """Return the watcher backend for 'auto', 'inotify' or 'poll'."""
+    if kind not in ('auto', 'inotify', 'poll'):
+        raise ValueError(f'Unknown watcher backend: {kind}')
+    if kind == 'inotify' or (kind == 'auto' and sys.platform.startswith('linux')):
+        try:
+            return _InotifyBackend()
+        except (OSError, AttributeError):
+            if kind == 'inotify': raise
+    return _PollingBackend()
+
+
+class _PollingBackend:
+    """Watcher backend that doesn't know anything: every check looks at the
+    size and modification time of every watched file (see _restamp).
+    Works everywhere."""
+    def watch(self, path):
+        pass
+    def watch_directory(self, path):
+        pass
+    def unwatch_directory(self, path):
+        pass
+    def changed_paths(self):
+        """Return the set of paths that may have changed, or None for 'any of them'."""
+        return None
+    def close(self):
+        pass
+
+
+class _InotifyBackend:
+    """Watcher backend that lets Linux tell us which files changed, so we only
+    check those. While nothing changes, a check is a single read() that
+    returns nothing.
+
+    We watch the directories rather than the files themselves, because many
+    editors save by writing a new file and renaming it over the old one."""
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+    _MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+             | IN_DELETE_SELF | IN_MOVE_SELF)
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # directory -> watch descriptor, or None while the directory doesn't
+        # exist (say a git checkout deleted it): we try again at every check,
+        # and until then everything must be checked.
+        self.dirs = {}
+        # watch descriptor -> directory
+        self.wds = {}
+        # directory -> {file name: paths as given to watch()}
+        self.files = {}
+        # directory -> directory as given to watch_directory()
+        self.trees = {}
+        # True if we may have missed events, so everything must be checked.
+        self.overflow = False
+        # True if we couldn't watch some directory, so we must always poll.
+        self.incomplete = False
+        # watch() is called from the game thread, changed_paths() maybe not.
+        self._lock = threading.Lock()
+
+    def watch(self, path):
+        directory, name = os.path.split(os.path.abspath(path))
+        with self._lock:
+            self.files.setdefault(directory, {}).setdefault(name, set()).add(path)
+            self._watch_dir(directory)
+
+    def watch_directory(self, path):
+        """Any change in the directory makes changed_paths() return it."""
+        directory = os.path.abspath(path)
+        with self._lock:
+            self.trees[directory] = path
+            self._watch_dir(directory)
+
+    def unwatch_directory(self, path):
+        """Stop watching a directory given to watch_directory (it was deleted)."""
+        directory = os.path.abspath(path)
+        with self._lock:
+            self.trees.pop(directory, None)
+            if directory in self.files: return
+            wd = self.dirs.pop(directory, None)
+            if wd is not None:
+                self.wds.pop(wd, None)
+                self._rm_watch(self.fd, wd)
+
+    def _watch_dir(self, directory):
+        if self.dirs.get(directory) is not None: return
+        wd = self._add_watch(self.fd, os.fsencode(directory), self._MASK)
+        if wd < 0:
+            if ctypes.get_errno() not in (errno.ENOENT, errno.ENOTDIR):
+                # Out of watches.
+                self.incomplete = True
+            self.dirs[directory] = None
+            return
+        self.dirs[directory] = wd
+        self.wds[wd] = directory
+
+    def _forget(self, wd, mask):
+        """The directory went away (or was moved): its watch is no good anymore."""
+        directory = self.wds.pop(wd, None)
+        if directory is None: return
+        self.dirs[directory] = None
+        if mask & self.IN_MOVE_SELF:
+            # It still watches the directory, wherever it is now.
+            self._rm_watch(self.fd, wd)
+
+    def changed_paths(self):
+        """Return the set of paths that may have changed, or None for 'any of them'."""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            with self._lock:
+                while offset < len(data):
+                    (wd, mask, _cookie, length) = self._EVENT.unpack_from(data, offset)
+                    offset += self._EVENT.size
+                    name = os.fsdecode(data[offset:offset+length].rstrip(b'\0'))
+                    offset += length
+                    if mask & self.IN_Q_OVERFLOW:
+                        self.overflow = True
+                    directory = self.wds.get(wd)
+                    if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                        self._forget(wd, mask)
+                    changed.update(self.files.get(directory, {}).get(name, ()))
+                    if directory in self.trees: changed.add(self.trees[directory])
+        with self._lock:
+            # Watch again the directories that were deleted, if they're back.
+            # Until we could, changes in them may have been missed.
+            missing = [directory for (directory, wd) in self.dirs.items() if wd is None]
+            for directory in missing:
+                self._watch_dir(directory)
+        if self.overflow or self.incomplete or missing:
+            self.overflow = False
+            return None
+        return changed
+
+    def close(self):
+        if self.fd < 0: return
+        os.close(self.fd)
+        self.fd = -1
+
+
+class _ReloadJob:
+    """A resource reload, done one step (load command) at a time.
+
+    When staged, the steps write to copies of pyxel's banks, and the copies
+    are only written back once all the steps are done (the commit). This way
+    a reload can be spread over several frames without the game ever seeing
+    half of it."""
+    def __init__(self, repyxel, changed, prepared, staged):
+        self.changed = changed
+        self.prepared = prepared
+        self.banks = _StagedBanks() if staged else _LIVE_BANKS
+        self.done = 0
+        self.total = len(repyxel.load_list) + len(repyxel._directory_loads(changed))
+        # Where the reload wrote, once it's done.
+        self.dirty = None
+        # True once we must finish this reload without stopping.
+        self.no_budget = False
+        self._steps = repyxel._reload_steps(self)
+
+    def run(self, budget):
+        """Run steps for about 'budget' seconds (None for no limit), at least one.
+        Return True once the reload is done and committed."""
+        start = time.perf_counter()
+        while True:
+            try:
+                next(self._steps)
+            except StopIteration as done:
+                self.dirty = done.value
+                self.go_live()
+                return True
+            self.done += 1
+            # Once all the steps are done, we commit right away.
+            if self.done < self.total and budget is not None and not self.no_budget \
+                    and time.perf_counter() - start >= budget:
+                return False
+
+    def go_live(self):
+        """Commit what we staged, and write directly to pyxel's banks from now on."""
+        if self.banks is _LIVE_BANKS: return
+        self.banks.commit()
+        self.banks = _LIVE_BANKS
+        self.no_budget = True
+
+
+class _NeedsLiveBanks(Exception):
+    """Raised by _StagedBanks for what can only be done on pyxel's own banks."""
+
+
+class _LiveBanks:
+    """Pyxel's banks. Load commands write through this (or a _StagedBanks)."""
+    @property
+    def images(self): return pyxel.images
+    @property
+    def tilemaps(self): return pyxel.tilemaps
+    @property
+    def sounds(self): return pyxel.sounds
+    @property
+    def musics(self): return pyxel.musics
+    def load(self, **kwargs):
+        pyxel.load(**kwargs)
+
+_LIVE_BANKS = _LiveBanks()
+
+
+class _StagedBanks:
+    """Copies of pyxel's banks. A bank is copied the first time it's used,
+    and commit() writes all the copies back at once."""
+    def __init__(self):
+        self.images = _StagedList(pyxel.images, _copy_image, _restore_image)
+        self.tilemaps = _StagedList(pyxel.tilemaps, _copy_tilemap, _restore_tilemap)
+        self.sounds = _StagedList(pyxel.sounds, _copy_sound, _restore_sound)
+        self.musics = _StagedList(pyxel.musics, _copy_music, _restore_music)
+    def load(self, **kwargs):
+        # pyxel.load can only load into pyxel's own banks.
+        raise _NeedsLiveBanks()
+    def commit(self):
+        for staged in (self.images, self.tilemaps, self.sounds, self.musics):
+            staged.commit()
+
+
+class _StagedList:
+    """Copies of the items of one of pyxel's lists of banks."""
+    def __init__(self, banks, copy, restore):
+        self.banks = banks
+        self.copy = copy
+        self.restore = restore
+        self.copies = {}
+    def __len__(self):
+        return len(self.banks)
+    def __getitem__(self, index):
+        if index not in self.copies:
+            self.copies[index] = self.copy(self.banks[index])
+        return self.copies[index]
+    def commit(self):
+        for (index, copy) in self.copies.items():
+            self.restore(self.banks[index], copy)
+
+
+def _copy_image(image):
+    copy = pyxel.Image(image.width, image.height)
+    copy.blt(0, 0, image, 0, 0, image.width, image.height)
+    return copy
+
+def _restore_image(image, copy):
+    image.blt(0, 0, copy, 0, 0, copy.width, copy.height)
+
+def _copy_tilemap(tilemap):
+    copy = pyxel.Tilemap(tilemap.width, tilemap.height, tilemap.imgsrc)
+    copy.blt(0, 0, tilemap, 0, 0, tilemap.width, tilemap.height)
+    return copy
+
+def _restore_tilemap(tilemap, copy):
+    tilemap.imgsrc = copy.imgsrc
+    tilemap.blt(0, 0, copy, 0, 0, copy.width, copy.height)
+
+def _copy_sound(sound):
+    copy = pyxel.Sound()
+    _restore_sound(copy, sound)
+    return copy
+
+def _restore_sound(sound, copy):
+    # Only what changed, so a sound that's playing isn't disturbed for nothing.
+    for field in _SOUND_FIELDS:
+        values = getattr(copy, field).to_list()
+        if getattr(sound, field).to_list() != values:
+            getattr(sound, field).from_list(values)
+    if sound.speed != copy.speed:
+        sound.speed = copy.speed
+
+def _copy_music(music):
+    copy = pyxel.Music()
+    _restore_music(copy, music)
+    return copy
+
+def _restore_music(music, copy):
+    _set_music_seqs(music, [seq.to_list() for seq in copy.seqs])
+
+def _set_music_seqs(music, seqs):
+    """Give the music these seqs (one per channel). Only the seqs that
+    changed are rewritten, in place, so the music keeps playing."""
+    current = [seq.to_list() for seq in music.seqs]
+    if len(current) != len(seqs):
+        music.set(*seqs)
+        return
+    for (seq, old, new) in zip(music.seqs, current, seqs):
+        if old != new:
+            seq.from_list(new)
 
 
 class _ReloadImage:
@@ -227,23 +2001,131 @@ class _PyxelLoad_Command:
     def __init__(self, filename, args_dict):
         self._filename = filename
         self.args = args_dict
+        # The file as we last loaded it, so reload can tell what changed.
+        self._data = None
+        self._parts = None
     def filename(self):
         return self._filename
-    def exec(self):
-        pyxel.load(**self.args)
+    def exec(self, banks=None):
+        (banks or _LIVE_BANKS).load(**self.args)
+        with open(self._filename, 'rb') as f:
+            self._data = f.read()
+        self._parts = None
+    def writes(self):
+        """The banks this command loads into, as (kind, index, None)."""
+        return [(kind, index, None)
+                for kind in _PYXRES_KINDS if not self.args.get('excl_' + kind)
+                for index in range(len(getattr(pyxel, kind)))]
+    def prepare(self):
+        """Read the file and parse the entries that changed since we last
+        loaded it; this part doesn't touch pyxel's banks. The changes are
+        {kind: (old count, new count, [(index, old entry, new entry)])},
+        or None if the whole file must be reloaded."""
+        with open(self._filename, 'rb') as f:
+            data = f.read()
+        old = self._parts
+        if old is None and self._data is not None:
+            old = _split_pyxres(self._data)
+        new = _split_pyxres(data)
+        if old is None or new is None or old[0] != new[0]:
+            # Not a file we can split, or something outside the entries changed.
+            return (data, new, None)
+        changes = {}
+        try:
+            for kind in _PYXRES_KINDS:
+                if self.args.get('excl_' + kind): continue
+                (old_entries, new_entries) = (old[1][kind], new[1][kind])
+                if old_entries == new_entries: continue
+                changed = [(index, _parse_pyxres_entry(old_entries[index]) if index < len(old_entries) else {},
+                            _parse_pyxres_entry(text))
+                           for (index, text) in enumerate(new_entries)
+                           if index >= len(old_entries) or old_entries[index] != text]
+                changes[kind] = (len(old_entries), len(new_entries), changed)
+        except ValueError:
+            return (data, new, None)
+        return (data, new, changes)
+    def reload(self, prepared=None, banks=None):
+        """Apply only the images, tilemaps, sounds and musics that changed
+        since we last loaded the file, and return where we wrote."""
+        banks = banks or _LIVE_BANKS
+        (data, parts, changes) = prepared or self.prepare()
+        if changes is None or not set(self.args) <= _PYXEL_LOAD_PARTS_ARGS:
+            return self.exec(banks)
+        reload_whole = []
+        written = []
+        for (kind, (old_count, new_count, changed)) in changes.items():
+            kind_written = _apply_pyxres_entries(getattr(banks, kind), kind, old_count, new_count, changed)
+            if kind_written is None:
+                reload_whole.append(kind)
+            else:
+                written += kind_written
+        if reload_whole:
+            args = dict(self.args)
+            for kind in _PYXRES_KINDS:
+                if kind not in reload_whole: args['excl_' + kind] = True
+            banks.load(**args)
+            written += [(kind, index, None) for kind in reload_whole
+                        for index in range(len(getattr(pyxel, kind)))]
+        self._data = data
+        self._parts = parts
+        return written
 
 class _ImageLoad_Command:
     """Command for pyxel.images[i].load"""
-    def __init__(self, image_index, x, y, filename, incl_colors):
+    def __init__(self, image_index, x, y, filename, incl_colors, cache=None):
         self.image_index = image_index
         self.x = x
         self.y = y
         self._filename = filename
         self.incl_colors = incl_colors
+        self.cache = cache
+        self.size = None
+        # The pixels we loaded last time, so reload can tell what changed.
+        self._pixels = None
     def filename(self):
         return self._filename
-    def exec(self):
-        pyxel.images[self.image_index].load(self.x, self.y, self._filename, incl_colors=self.incl_colors)
+    def exec(self, banks=None):
+        self._apply_whole(banks or _LIVE_BANKS, *self._decode())
+    def _apply_whole(self, banks, image, pixels):
+        banks.images[self.image_index].blt(self.x, self.y, image, 0, 0, image.width, image.height)
+        self.size = (image.width, image.height)
+        self._pixels = pixels
+    def writes(self):
+        """The rectangle this command loads into, as ('images', index, (x, y, w, h)).
+        The rectangle is None (the whole bank) if we don't know the image size."""
+        rect = (self.x, self.y) + self.size if self.size else None
+        return [('images', self.image_index, rect)]
+    def prepare(self):
+        """Decode the file; this part doesn't touch pyxel's banks."""
+        return self._decode()
+    def reload(self, prepared=None, banks=None):
+        """Write only the rectangles of the image that changed, and return them."""
+        banks = banks or _LIVE_BANKS
+        (image, pixels) = prepared or self._decode()
+        if self._pixels is None or self.size != (image.width, image.height):
+            self._apply_whole(banks, image, pixels)
+            return self.writes()
+        rects = _changed_rects(self._pixels, pixels, image.width)
+        bank = banks.images[self.image_index]
+        for (x, y, w, h) in rects:
+            bank.blt(self.x + x, self.y + y, image, x, y, w, h)
+        self._pixels = pixels
+        return [('images', self.image_index, (self.x + x, self.y + y, w, h)) for (x, y, w, h) in rects]
+    def _decode(self):
+        """Return the file as (pyxel.Image, its pixels), from the cache if we can."""
+        key = None
+        if self.cache:
+            key = self.cache.key('image', _file_digest(self._filename), self.incl_colors, _palette())
+            cached = self.cache.get(key)
+            if cached:
+                (width, height, pixels) = cached
+                image = _image_from_pixels(width, height, pixels)
+                if image: return (image, pixels)
+        image = pyxel.Image.from_image(self._filename, incl_colors=self.incl_colors)
+        pixels = _image_pixels(image)
+        if key:
+            self.cache.put(key, image.width, image.height, pixels)
+        return (image, pixels)
 
 class _TilemapLoad_Command:
     """Command for pyxel.tilemap[i].load"""
@@ -253,10 +2135,49 @@ class _TilemapLoad_Command:
         self.y = y
         self._filename = filename
         self.layer = layer
+        self.size = None
+        # The layer's tiles we loaded last time (see _tmx_layer_grid),
+        # so reload can tell what changed.
+        self._grid = None
     def filename(self):
         return self._filename
-    def exec(self):
-        pyxel.tilemaps[self.tilemap_index].load(self.x, self.y, self._filename, self.layer)
+    def exec(self, banks=None):
+        (banks or _LIVE_BANKS).tilemaps[self.tilemap_index].load(self.x, self.y, self._filename, self.layer)
+        self._grid = self._read_grid()
+        self.size = self._grid[:2] if self._grid else _tmx_size(self._filename)
+    def writes(self):
+        """The rectangle this command loads into, as ('tilemaps', index, (x, y, w, h)).
+        The rectangle is None (the whole bank) if we don't know the map size."""
+        rect = (self.x, self.y) + self.size if self.size else None
+        return [('tilemaps', self.tilemap_index, rect)]
+    def prepare(self):
+        """Read the new tiles; this part doesn't touch pyxel's banks."""
+        grid = self._read_grid()
+        if grid is None or not hasattr(pyxel.Tilemap, 'from_tmx'):
+            return None
+        return (grid, pyxel.Tilemap.from_tmx(self._filename, self.layer))
+    def reload(self, prepared=None, banks=None):
+        """Write only the tiles that changed, and return where."""
+        banks = banks or _LIVE_BANKS
+        prepared = prepared or self.prepare()
+        if prepared is None or self._grid is None or not _same_tmx_setup(prepared[0], self._grid):
+            # New size or tilesets: the tiles that didn't change may look different.
+            self.exec(banks)
+            return self.writes()
+        (grid, tilemap) = prepared
+        (width, _height, tiles, _setup) = grid
+        rects = _changed_rects(self._grid[2], tiles, width, cell_size=4)
+        bank = banks.tilemaps[self.tilemap_index]
+        for (x, y, w, h) in rects:
+            bank.blt(self.x + x, self.y + y, tilemap, x, y, w, h)
+        self._grid = grid
+        return [('tilemaps', self.tilemap_index, (self.x + x, self.y + y, w, h)) for (x, y, w, h) in rects]
+    def _read_grid(self):
+        try:
+            with open(self._filename, 'rb') as f:
+                return _tmx_layer_grid(f.read(), self.layer)
+        except OSError:
+            return None
 
 class _Watch_Command:
     """Command for the code manually asking us to watch a file."""
@@ -264,9 +2185,503 @@ class _Watch_Command:
         self._filename = filename
     def filename(self):
         return self._filename
-    def exec(self):
+    def exec(self, banks=None):
+        pass
+    def prepare(self):
+        return None
+    def reload(self, prepared=None, banks=None):
+        self.exec(banks)
+    def writes(self):
+        return []
+
+
+class _AssetCache:
+    """Decoded assets kept on disk, so we don't decode them again at the next launch.
+
+    Each entry is a file named after a hash of everything that went into
+    decoding it (the file's digest, the load arguments, the palette). It holds
+    a small header and then the pixels, one byte each. Reading one is a
+    memory-mapped read. We remove the least recently used entries when the
+    cache grows past max_bytes."""
+    _HEADER = struct.Struct('<4sII')
+    _MAGIC = b'RPX1'
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts):
+        parts += (getattr(pyxel, 'VERSION', None),)
+        return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+    def get(self, key):
+        """Return (width, height, pixels), or None if it's not in the cache."""
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                (magic, width, height) = self._HEADER.unpack_from(mapped)
+                pixels = mapped[self._HEADER.size:]
+            # Remember it was used recently.
+            os.utime(path)
+        except (OSError, ValueError, struct.error):
+            return None
+        if magic != self._MAGIC or len(pixels) != width * height:
+            self._remove(path)
+            return None
+        return (width, height, pixels)
+
+    def put(self, key, width, height, pixels):
+        try:
+            (fd, temp_path) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._HEADER.pack(self._MAGIC, width, height))
+                f.write(pixels)
+            os.replace(temp_path, os.path.join(self.directory, key))
+            self._evict()
+        except OSError:
+            # A cache we can't write to is just a cache that misses.
+            pass
+
+    def _evict(self):
+        """Remove the least recently used entries until we fit in max_bytes."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file(): continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for (_mtime, size, path) in entries:
+            if total <= self.max_bytes: break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# Snapshot files: this header, the length of each out-of-band buffer,
+# the pickle, then the buffers (each starting on a multiple of 64 bytes).
+_SNAPSHOT_HEADER = struct.Struct('<4sIQ')
+_SNAPSHOT_MAGIC = b'RPS1'
+_SNAPSHOT_ALIGN = 64
+# Bytearrays and arrays at least this big are written out of band.
+_SNAPSHOT_OUT_OF_BAND = 4096
+_PYXEL_BANKS = ('images', 'tilemaps', 'sounds', 'musics')
+
+
+class _SnapshotPickler(pickle.Pickler):
+    """Pickles the app. The ReloadPyxel object and pyxel's banks are saved
+    as references, and found again when the snapshot is restored.
+
+    Big bytearrays and arrays, and memoryviews, are saved as references
+    too: to a PickleBuffer, which pickle writes out of band. Pickle would
+    write them in band otherwise (and it writes a bytearray without asking
+    reducer_override, but persistent_id is always asked first)."""
+    def __init__(self, f, repyxel, buffers):
+        super().__init__(f, protocol=5, buffer_callback=buffers.append)
+        self.repyxel = repyxel
+        # type of bank -> kind, so we only look at the banks for those.
+        self.bank_kinds = {type(getattr(pyxel, kind)[0]): kind for kind in _PYXEL_BANKS if len(getattr(pyxel, kind))}
+        # id -> (number, object) for what we wrote out of band, so each is
+        # written once. Persistent ids aren't memoized like other objects.
+        self.out_of_band = {}
+    def persistent_id(self, obj):
+        if obj is self.repyxel: return ('repyxel',)
+        if type(obj) in (bytearray, array.array, memoryview):
+            return self._out_of_band_id(obj)
+        kind = self.bank_kinds.get(type(obj))
+        if kind is None: return None
+        # Pyxel gives a new object each time its lists are indexed, so
+        # images and tilemaps are matched by where their data is.
+        address = _bank_address(obj)
+        for (index, bank) in enumerate(getattr(pyxel, kind)):
+            if bank is obj or (address is not None and _bank_address(bank) == address):
+                return (kind, index)
+        raise pickle.PicklingError(f'A pyxel {type(obj).__name__} that is not in pyxel.{kind} '
+                                   'can\'t be saved in a snapshot.')
+    def _out_of_band_id(self, obj):
+        seen = self.out_of_band.get(id(obj))
+        if seen: return ('seen', seen[0])
+        if type(obj) is memoryview:
+            # Can't be pickled otherwise, whatever its size.
+            if not obj.c_contiguous: return None
+            pid = ('memoryview', pickle.PickleBuffer(obj), obj.format, obj.shape)
+        elif len(obj) * getattr(obj, 'itemsize', 1) < _SNAPSHOT_OUT_OF_BAND:
+            return None
+        elif type(obj) is bytearray:
+            pid = ('bytearray', pickle.PickleBuffer(obj))
+        else:
+            pid = ('array', pickle.PickleBuffer(obj), obj.typecode)
+        self.out_of_band[id(obj)] = (len(self.out_of_band), obj)
+        return pid
+
+
+def _bank_address(bank):
+    """The address of an image's or tilemap's data, or None for the banks
+    that don't tell us (sounds and musics)."""
+    if not hasattr(bank, 'data_ptr'): return None
+    return ctypes.cast(bank.data_ptr(), ctypes.c_void_p).value
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    def __init__(self, f, repyxel, buffers):
+        super().__init__(f, buffers=buffers)
+        self.repyxel = repyxel
+        # What we rebuilt from out of band buffers, in order (see _SnapshotPickler).
+        self.out_of_band = []
+    def persistent_load(self, pid):
+        if pid == ('repyxel',): return self.repyxel
+        if pid[0] == 'seen':
+            return self.out_of_band[pid[1]]
+        # The buffers written out of band are views of the snapshot file.
+        if pid[0] == 'bytearray':
+            obj = bytearray(pid[1])
+        elif pid[0] == 'array':
+            obj = array.array(pid[2])
+            obj.frombytes(pid[1])
+        elif pid[0] == 'memoryview':
+            obj = memoryview(pid[1]).cast('B').cast(pid[2], pid[3])
+        else:
+            (kind, index) = pid
+            return getattr(pyxel, kind)[index]
+        self.out_of_band.append(obj)
+        return obj
+
+
+def _write_snapshot(filename, app, repyxel):
+    """Save the app to the file: big buffers (bytearrays, arrays, memoryviews)
+    are written as they are after the pickle, instead of inside it."""
+    buffers = []
+    data = io.BytesIO()
+    _SnapshotPickler(data, repyxel, buffers).dump(app)
+    views = [buffer.raw() for buffer in buffers]
+    directory = os.path.dirname(os.path.abspath(filename))
+    (fd, temp_path) = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, len(views), data.tell()))
+            f.write(struct.pack(f'<{len(views)}Q', *[view.nbytes for view in views]))
+            f.write(data.getbuffer())
+            for view in views:
+                f.write(bytes(-f.tell() % _SNAPSHOT_ALIGN))
+                f.write(view)
+        # Never leave a half-written snapshot behind.
+        os.replace(temp_path, filename)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _read_snapshot(filename, repyxel):
+    """Return the app saved in the file. The big buffers are copied straight
+    from the mapped file, without going through the pickle; memoryviews
+    point into it (copy-on-write)."""
+    with open(filename, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mapped)
+    (magic, count, size) = _SNAPSHOT_HEADER.unpack_from(view)
+    if magic != _SNAPSHOT_MAGIC:
+        raise pickle.UnpicklingError(f'{filename} is not a reloadpyxel snapshot.')
+    offset = _SNAPSHOT_HEADER.size
+    lengths = struct.unpack_from(f'<{count}Q', view, offset)
+    offset += 8 * count
+    data = view[offset:offset + size]
+    offset += size
+    buffers = []
+    for length in lengths:
+        offset += -offset % _SNAPSHOT_ALIGN
+        buffers.append(view[offset:offset + length])
+        offset += length
+    return _SnapshotUnpickler(io.BytesIO(data), repyxel, buffers).load()
+
+
+def _prepare_all(commands):
+    """Runs on the decoder thread: return {command: prepared} for the
+    commands that could be prepared. The others will do all their work
+    when they reload on the game thread."""
+    prepared = {}
+    for command in commands:
+        try:
+            prepared[command] = command.prepare()
+        except Exception:
+            # Maybe the file is mid-save; reload will try again and, if
+            # it's really broken, fail the way it does without a decoder.
+            pass
+    return prepared
+
+
+def _overlaps(writes, other_writes):
+    """Whether two lists of (kind, index, rectangle) touch the same place."""
+    for (kind, index, rect) in writes:
+        for (other_kind, other_index, other_rect) in other_writes:
+            if kind == other_kind and index == other_index and _rects_overlap(rect, other_rect):
+                return True
+    return False
+
+
+def _rects_overlap(rect, other_rect):
+    """Whether two (x, y, w, h) overlap. None is the whole bank."""
+    if rect is None or other_rect is None: return True
+    (x, y, w, h) = rect
+    (ox, oy, ow, oh) = other_rect
+    return x < ox + ow and ox < x + w and y < oy + oh and oy < y + h
+
+
+def _image_pixels(image):
+    """Return the pixels of a pyxel.Image, row after row, one byte per pixel."""
+    if hasattr(image, 'data_ptr'):
+        return ctypes.string_at(image.data_ptr(), image.width * image.height)
+    return bytes(image.pget(x, y) for y in range(image.height) for x in range(image.width))
+
+
+def _image_from_pixels(width, height, pixels):
+    """Return a new pyxel.Image with these pixels, or None if pyxel
+    doesn't let us write them directly."""
+    image = pyxel.Image(width, height)
+    if not hasattr(image, 'data_ptr'): return None
+    ctypes.memmove(image.data_ptr(), pixels, width * height)
+    return image
+
+
+def _palette():
+    """The current pyxel palette, as a tuple of colors."""
+    colors = pyxel.colors
+    return tuple(colors.to_list() if hasattr(colors, 'to_list') else colors)
+
+
+def _changed_rects(old, new, width, cell_size=1):
+    """Compare two images given as bytes (cell_size bytes per pixel, 'width'
+    pixels per row) and return the rectangles (x, y, w, h) that changed.
+
+    Consecutive changed rows are grouped in one rectangle, as wide as
+    needed to cover the changes in all of them."""
+    if old == new: return []
+    rects = []
+    band = None
+    row_size = width * cell_size
+    for y in range(len(new) // row_size):
+        start = y * row_size
+        old_row = old[start:start + row_size]
+        new_row = new[start:start + row_size]
+        if old_row == new_row:
+            if band: rects.append(band)
+            band = None
+            continue
+        # XOR the rows as big numbers: the highest and lowest bits
+        # that are set tell us the first and last pixels that differ.
+        diff = int.from_bytes(old_row, 'big') ^ int.from_bytes(new_row, 'big')
+        first = width - 1 - (diff.bit_length() - 1) // (8 * cell_size)
+        last = width - 1 - ((diff & -diff).bit_length() - 1) // (8 * cell_size)
+        if band is None:
+            band = (first, y, last - first + 1, 1)
+        else:
+            (x, band_y, w, h) = band
+            x2 = max(x + w, last + 1)
+            x = min(x, first)
+            band = (x, band_y, x2 - x, h + 1)
+    if band: rects.append(band)
+    return rects
+
+
+def _tmx_size(filename):
+    """Return (width, height), in tiles, of a TMX map, or None if we can't tell."""
+    try:
+        with open(filename, 'rb') as f:
+            for (_event, element) in ElementTree.iterparse(f, events=('start',)):
+                # The first element is <map>
+                return (int(element.get('width')), int(element.get('height')))
+    except (OSError, ElementTree.ParseError, TypeError, ValueError):
         pass
+    return None
+
+
+def _tmx_layer_grid(data, layer):
+    """Return (width, height, tiles, setup) for a layer of a TMX map, where
+    tiles has the tile ids (gids), 4 bytes each, row after row, and setup is
+    what else decides how they look: the map's and layer's attributes and
+    the tilesets (their firstgid, columns...). Returns None if we can't read
+    it: we only read the CSV encoding, and not infinite maps."""
+    try:
+        root = ElementTree.fromstring(data)
+        element = root.findall('layer')[layer]
+        tiles = element.find('data')
+        if tiles is None or tiles.get('encoding') != 'csv' or tiles.find('chunk') is not None:
+            return None
+        (width, height) = (int(element.get('width')), int(element.get('height')))
+        gids = array.array('I', [int(gid) for gid in tiles.text.replace('\n', '').split(',') if gid.strip()])
+    except (ElementTree.ParseError, IndexError, TypeError, ValueError, OverflowError):
+        return None
+    if len(gids) != width * height: return None
+    setup = (sorted(root.attrib.items()), sorted(element.attrib.items()),
+             [ElementTree.tostring(tileset) for tileset in root.findall('tileset')])
+    return (width, height, gids.tobytes(), setup)
+
+
+def _same_tmx_setup(grid, old_grid):
+    """Whether two grids from _tmx_layer_grid differ only in their tiles."""
+    return grid[:2] == old_grid[:2] and grid[3] == old_grid[3]
+
+
+# The parts of a .pyxres file that we can reload one by one.
+_PYXRES_KINDS = ('images', 'tilemaps', 'sounds', 'musics')
+# If pyxel.load gets other arguments, we let it reload the whole file.
+_PYXEL_LOAD_PARTS_ARGS = {'filename', 'excl_images', 'excl_tilemaps', 'excl_sounds', 'excl_musics'}
+# The kinds where entries can be added or removed without reloading them all.
+_PYXRES_ADDABLE_KINDS = ('sounds', 'musics')
+# The line that starts each entry of a .pyxres file, e.g. [[images]].
+_PYXRES_ENTRY_HEADER = re.compile(r'^\[\[(images|tilemaps|sounds|musics)\]\][ \t]*\r?$', re.MULTILINE)
+_TOML_TABLE_LINE = re.compile(r'^[ \t]*\[', re.MULTILINE)
+_SOUND_FIELDS = ('notes', 'tones', 'volumes', 'effects')
+_HEX_DIGITS = '0123456789abcdef'
+
+
+def _split_pyxres(data):
+    """Split a .pyxres file into the text before its first entry and the
+    text of each of its images, tilemaps, sounds and musics, as
+    (header, {kind: [text, ...]}). Returns None if it's in a format we
+    don't read (then pyxel.load reloads the whole file)."""
+    if tomllib is None: return None
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            text = archive.read('pyxel_resource.toml').decode('utf-8')
+    except (zipfile.BadZipFile, KeyError, ValueError):
+        return None
+    parts = _PYXRES_ENTRY_HEADER.split(text)
+    # Any other line starting with [ may be a table we'd split wrongly.
+    if any(_TOML_TABLE_LINE.search(part) for part in parts[::2]):
+        return None
+    entries = {kind: [] for kind in _PYXRES_KINDS}
+    for (kind, entry) in zip(parts[1::2], parts[2::2]):
+        entries[kind].append(entry)
+    return (parts[0], entries)
+
+
+def _parse_pyxres_entry(text):
+    """Parse the text of one image, tilemap, sound or music of a .pyxres
+    file. Raises ValueError if it isn't valid."""
+    # Pyxel writes each value on one line, as numbers or lists of them,
+    # which json reads many times faster than tomllib.
+    entry = {}
+    for line in text.splitlines():
+        if not line.strip(): continue
+        (key, _, value) = line.partition('=')
+        key = key.strip()
+        if not key.isidentifier() or key in entry:
+            return tomllib.loads(text)
+        try:
+            entry[key] = json.loads(value)
+        except ValueError:
+            return tomllib.loads(text)
+    return entry
+
+
+def _apply_pyxres_entries(banks, kind, old_count, new_count, changed):
+    """Write the entries that changed, as [(index, old entry, new entry)],
+    into these images, tilemaps, sounds or musics. Returns where we wrote,
+    as a list of (kind, index, rectangle), or None if they must be
+    reloaded whole instead."""
+    if new_count > len(banks):
+        return None
+    if old_count != new_count and kind not in _PYXRES_ADDABLE_KINDS:
+        return None
+    apply = _PYXRES_APPLY[kind]
+    written = []
+    for (index, old, new) in changed:
+        # A new sound or music is applied whole. One that was removed is
+        # left alone, as pyxel.load would.
+        if old == new: continue
+        rects = apply(banks[index], old, new)
+        if rects is None:
+            return None
+        written += [(kind, index, rect) for rect in rects]
+    return written
+
+
+def _padded_row(entry, y, length):
+    """Row y of a .pyxres image or tilemap. Pyxel writes a run of the same
+    value at the end of a row only once, and likewise a run of the same
+    rows at the end of the data, so we repeat the last ones."""
+    data = entry['data']
+    if not data: return [0] * length
+    row = data[y] if y < len(data) else data[-1]
+    if not row: return [0] * length
+    return row + [row[-1]] * (length - len(row))
+
+
+def _rows_to_rects(rows, width):
+    """Turn a sorted list of row numbers into (0, y, width, h) rectangles."""
+    rects = []
+    for y in rows:
+        if rects and rects[-1][1] + rects[-1][3] == y:
+            (x, band_y, w, h) = rects[-1]
+            rects[-1] = (x, band_y, w, h + 1)
+        else:
+            rects.append((0, y, width, 1))
+    return rects
+
+
+def _apply_pyxres_image(image, old, new):
+    if (old['width'], old['height']) != (new['width'], new['height']): return None
+    width = new['width']
+    changed_rows = []
+    for y in range(new['height']):
+        row = _padded_row(new, y, width)
+        if row == _padded_row(old, y, width): continue
+        if max(row) < len(_HEX_DIGITS):
+            image.set(0, y, [''.join(_HEX_DIGITS[c] for c in row)])
+        else:
+            for (x, c) in enumerate(row):
+                image.pset(x, y, c)
+        changed_rows.append(y)
+    return _rows_to_rects(changed_rows, width)
+
+
+def _apply_pyxres_tilemap(tilemap, old, new):
+    if (old['width'], old['height']) != (new['width'], new['height']): return None
+    changed_rows = set()
+    if old['imgsrc'] != new['imgsrc']:
+        # Every tile looks different now.
+        tilemap.imgsrc = new['imgsrc']
+        changed_rows.update(range(new['height']))
+    # Each tile is two numbers in the row: its x and y in the image.
+    length = new['width'] * 2
+    for y in range(new['height']):
+        row = _padded_row(new, y, length)
+        old_row = _padded_row(old, y, length)
+        if row == old_row: continue
+        for x in range(0, length, 2):
+            if row[x:x+2] != old_row[x:x+2]:
+                tilemap.pset(x // 2, y, (row[x], row[x+1]))
+        changed_rows.add(y)
+    return _rows_to_rects(sorted(changed_rows), new['width'])
+
+
+def _apply_pyxres_sound(sound, old, new):
+    if set(new) - set(_SOUND_FIELDS) - {'speed'}: return None
+    for field in _SOUND_FIELDS:
+        if old.get(field) != new.get(field):
+            getattr(sound, field).from_list(new.get(field, []))
+    if old.get('speed') != new.get('speed'):
+        sound.speed = new['speed']
+    return [None]
 
 
+def _apply_pyxres_music(music, old, new):
+    if set(new) != {'seqs'}: return None
+    _set_music_seqs(music, new['seqs'])
+    return [None]
 
 
+_PYXRES_APPLY = {
+    'images': _apply_pyxres_image,
+    'tilemaps': _apply_pyxres_tilemap,
+    'sounds': _apply_pyxres_sound,
+    'musics': _apply_pyxres_music,
+}